@@ -0,0 +1,356 @@
+# bench.py
+# Offline benchmarks for the bot's hot paths. No Discord connection is needed: handlers are driven
+# with synthetic guilds, members and messages, Groq and restcountries are served by local stub
+# servers, and the database is a local Postgres given by BENCH_DB_URL (use a throwaway database).
+#
+#   python bench.py                         # every benchmark
+#   python bench.py spam                    # pure in-memory micro-benchmarks need no Postgres
+#   python bench.py messages quiz --guilds 50 --users 5000 --events 20000
+import os
+import time
+import random
+import socket
+import asyncio
+import argparse
+import itertools
+import resource
+import contextlib
+import tracemalloc
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+STUB_PORT = _free_port()
+STUB_URL = f"http://127.0.0.1:{STUB_PORT}"
+os.environ.update(DB_URL=os.environ.get('BENCH_DB_URL', 'postgres://postgres@127.0.0.1/arts_bench'), GROQ_BASE_URL=STUB_URL,
+                  METRICS_PORT='0', COUNTRY_SNAPSHOT_PATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_countries.json'))
+for key, value in {'BOT_TOKEN': 'bench', 'GROQ_API_KEY': 'bench', 'MASTER_USER_ID': '1'}.items():
+    os.environ.setdefault(key, value)
+import discord
+from aiohttp import web
+import aiohttp
+import main
+
+# --- Stub Servers ---
+STUB_GROQ_LATENCY = 0.05
+
+async def _stub_chat_completion(request):
+    await asyncio.sleep(STUB_GROQ_LATENCY)
+    return web.json_response({"id": "bench", "object": "chat.completion", "created": 0, "model": main.GROQ_MODEL,
+                              "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Beep boop."}}],
+                              "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}})
+
+async def _stub_countries(request):
+    return web.json_response([{"name": {"common": f"Country {i}", "official": f"Republic of Country {i}"}, "altSpellings": [f"C{i}", f"Cöuntry Number {i}"],
+                               "flags": {"png": f"{STUB_URL}/flags/{i}.png"}, "population": random.randint(0, 10**8)} for i in range(250)])
+
+async def _stub_flag(request):
+    return web.Response(body=b"\x89PNG", content_type='image/png')
+
+async def start_stub_servers():
+    app = web.Application()
+    app.router.add_post('/openai/v1/chat/completions', _stub_chat_completion)
+    app.router.add_get('/countries', _stub_countries)
+    app.router.add_get('/flags/{name}', _stub_flag)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', STUB_PORT).start()
+    return runner
+
+# --- Synthetic Discord Objects ---
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id, self.name, self.nick, self.bot = user_id, name, None, bot
+        self.mention = f"<@{user_id}>"
+    @property
+    def display_name(self): return self.nick or self.name
+    def mentioned_in(self, message): return False
+
+class FakeMember(FakeUser):
+    def __init__(self, guild, user_id, moderator=False, bot=False):
+        super().__init__(user_id, f"user{user_id}", bot)
+        self.guild, self.top_role, self.color = guild, 0, discord.Color.default()
+        self.guild_permissions = SimpleNamespace(manage_messages=moderator, administrator=False, manage_guild=moderator)
+    async def edit(self, nick=None, reason=None): self.nick = nick
+    async def timeout(self, duration, reason=None): pass
+
+class FakeMessage:
+    next_id = int(time.time() * 1000) << 22
+    def __init__(self, channel, author, content):
+        FakeMessage.next_id += 1
+        self.id, self.channel, self.guild, self.author = FakeMessage.next_id, channel, channel.guild, author
+        self.content = self.clean_content = content
+        self.reference, self.embeds, self.reactions, self.mentions = None, [discord.Embed()], [], []
+        self._state = main.bot._connection
+    async def add_reaction(self, emoji): pass
+    async def reply(self, content=None, **kwargs): return await self.channel.send(content, **kwargs)
+    async def edit(self, **kwargs): pass
+
+class FakeChannel:
+    def __init__(self, guild, channel_id):
+        self.guild, self.id, self.sent, self.messages = guild, channel_id, 0, {}
+        self.mention = f"<#{channel_id}>"
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, main.bot.user, content or "")
+    async def fetch_message(self, message_id): return self.messages[message_id]
+    def typing(self): return contextlib.nullcontext()
+    async def history(self, limit=None):
+        return
+        yield
+    def permissions_for(self, member): return SimpleNamespace(send_messages=True)
+
+class FakeGuild:
+    def __init__(self, guild_id, users, channels=3):
+        self.id, self.name = guild_id, f"Guild {guild_id}"
+        self.me = FakeMember(self, BOT_USER_ID, bot=True); self.me.top_role = 100
+        self.members = {guild_id * 10**6 + i: FakeMember(self, guild_id * 10**6 + i, moderator=i % 50 == 0) for i in range(users)}
+        self.channels = {guild_id * 100 + i: FakeChannel(self, guild_id * 100 + i) for i in range(channels)}
+    def get_member(self, user_id): return self.members.get(user_id)
+    def get_channel(self, channel_id): return self.channels.get(channel_id)
+    async def fetch_member(self, user_id):
+        if user_id not in self.members: raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Member")
+        return self.members[user_id]
+
+BOT_USER_ID = 42
+
+def build_world(guild_count, user_count):
+    main.bot._connection.user = FakeUser(BOT_USER_ID, "ARTS AUTOMATION", bot=True)
+    main.bot.loop = asyncio.get_running_loop()
+    guilds = {guild_id: FakeGuild(guild_id, max(user_count // guild_count, 2)) for guild_id in range(1, guild_count + 1)}
+    channels = {channel.id: channel for guild in guilds.values() for channel in guild.channels.values()}
+    main.bot.get_guild, main.bot.get_channel = guilds.get, channels.get
+    return guilds
+
+# --- Measurement ---
+def db_query_count():
+    return sum(hist[-1] for (name, _), hist in main.metric_histograms.items() if name == 'arts_db_query_seconds')
+
+def rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def drive(name, events, concurrency=100):
+    """Runs each (handler, args) pair as its own task, as the gateway dispatcher would."""
+    latencies, queries, rss = [], db_query_count(), rss_mib()
+    semaphore = asyncio.Semaphore(concurrency)
+    async def run(handler, args):
+        async with semaphore:
+            start = time.perf_counter()
+            await handler(*args)
+            latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*(run(handler, args) for handler, args in events))
+    await asyncio.gather(*list(main.chat_tasks.values()), return_exceptions=True)
+    await main.flush_user_writes()
+    report(name, len(latencies), time.perf_counter() - start, latencies, db_query_count() - queries, rss_mib() - rss)
+
+def report(name, count, elapsed, latencies, queries, rss_growth):
+    latencies = sorted(latencies) or [0.0]
+    p50, p99 = latencies[len(latencies) // 2], latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{name}: {count} events in {elapsed:.2f}s ({count / elapsed:.0f}/s), p50 {p50 * 1000:.2f}ms, p99 {p99 * 1000:.2f}ms, "
+          f"{queries / max(count, 1):.2f} DB queries/event, peak RSS +{rss_growth:.1f} MiB")
+
+@contextlib.contextmanager
+def timed_calls(name, latencies, items=lambda *args: 1):
+    # Records how long each call to main.<name> takes, once per item it handles.
+    original = getattr(main, name)
+    async def timed(*args):
+        start = time.perf_counter()
+        try: return await original(*args)
+        finally: latencies.extend([time.perf_counter() - start] * items(*args))
+    setattr(main, name, timed)
+    try: yield
+    finally: setattr(main, name, original)
+
+# --- Benchmarks ---
+def bench_spam(args):
+    users, messages = args.users, args.events * 100
+    keys = [(random.randrange(args.guilds), random.randrange(10**17, 10**18)) for _ in range(users)]
+    limiter, now, tripped = main.SpamLimiter(), 0.0, 0
+    start = time.perf_counter()
+    for i in range(messages):
+        guild_id, user_id = keys[i % users]
+        now += 0.00001
+        tripped += limiter.hit(guild_id, user_id, now)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    limiter, now = main.SpamLimiter(), 0.0
+    for guild_id, user_id in keys:
+        now += 0.00001
+        limiter.hit(guild_id, user_id, now)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"spam: {elapsed / messages * 1e9:.0f} ns/message over {users} active users ({tripped} trips), "
+          f"{held / 2**20:.1f} MiB for {len(limiter.windows)} entries ({held / len(limiter.windows):.0f} B/entry)")
+
+GUESS_COUNTRIES = [
+    {'name': {'common': "Côte d'Ivoire", 'official': "Republic of Côte d'Ivoire"}, 'altSpellings': ['CI', 'Ivory Coast']},
+    {'name': {'common': 'United States', 'official': 'United States of America'}, 'altSpellings': ['US', 'USA']},
+    {'name': {'common': 'São Tomé and Príncipe', 'official': 'Democratic Republic of São Tomé and Príncipe'}, 'altSpellings': ['ST']},
+    {'name': {'common': 'Guinea-Bissau', 'official': 'Republic of Guinea-Bissau'}, 'altSpellings': ['GW']},
+    {'name': {'common': 'Bahamas', 'official': 'Commonwealth of the Bahamas'}, 'altSpellings': ['BS']},
+    {'name': {'common': 'North Korea', 'official': "Democratic People's Republic of Korea"}, 'altSpellings': ['KP', 'DPRK']},
+    {'name': {'common': 'South Korea', 'official': 'Republic of Korea'}, 'altSpellings': ['KR', 'Korea, Republic of']},
+    {'name': {'common': 'Gambia', 'official': 'Republic of the Gambia'}, 'altSpellings': ['GM']},
+    {'name': {'common': 'Zambia', 'official': 'Republic of Zambia'}, 'altSpellings': ['ZM']},
+    {'name': {'common': 'Ireland', 'official': 'Republic of Ireland'}, 'altSpellings': ['IE', 'Éire']},
+    {'name': {'common': 'Iceland', 'official': 'Iceland'}, 'altSpellings': ['IS', 'Island']},
+]
+# Neighbouring names that are within typo distance of each other but must never be accepted for one another.
+GUESS_MISSES = [('North Korea', 'South Korea'), ('Gambia', 'Zambia'), ('Ireland', 'Iceland')]
+GUESS_VARIANTS = [lambda n: n, str.upper, lambda n: f"  {n.lower()}!! ", lambda n: n[:-1], lambda n: f"the {n}", lambda n: "definitely not it",
+                  lambda n: n.encode('ascii', 'ignore').decode(), lambda n: "lol", lambda n: n[:3]]
+
+def bench_guesses(args):
+    # A quiz channel's traffic: exact answers, case/accent/punctuation variants, typos and misses.
+    main.catalog_answer_keys = main.index_answer_keys(GUESS_COUNTRIES)
+    rounds = [(country, main.answer_keys(country)) for country in GUESS_COUNTRIES]
+    guesses = [(answers, random.choice(GUESS_VARIANTS)(random.choice([country['name']['common'], *country['altSpellings']])))
+               for country, answers in (random.choice(rounds) for _ in range(args.events * 10))]
+    keys = {country['name']['common']: answers for country, answers in rounds}
+    misses = [(keys[a], variant(b)) for pair in GUESS_MISSES for a, b in (pair, pair[::-1]) for variant in GUESS_VARIANTS[:4]]
+    # Two-letter codes are everyday words ("no", "it", "in"), so they never count for their own country either.
+    misses += [(answers, variant(code)) for country, answers in rounds for code in country['altSpellings'] if len(code) <= 2 for variant in GUESS_VARIANTS[:3]]
+    guesses += misses * (args.events // len(misses))
+    start = time.perf_counter()
+    accepted = sum(main.is_correct_guess(guess, answers) for answers, guess in guesses)
+    elapsed = time.perf_counter() - start
+    wrong = [guess for answers, guess in misses if main.is_correct_guess(guess, answers)]
+    start = time.perf_counter()
+    for _, country in zip(range(args.events), itertools.cycle(GUESS_COUNTRIES)): main.answer_keys(country)
+    index_elapsed = time.perf_counter() - start
+    print(f"guesses: {len(guesses) / elapsed:.0f} guesses/s ({elapsed / len(guesses) * 1e9:.0f} ns/guess, {accepted / len(guesses):.0%} accepted), "
+          f"{index_elapsed / args.events * 1e6:.1f} us to index a round, {len(wrong)}/{len(misses)} near-miss guesses accepted")
+
+async def bench_messages(guilds, args):
+    events = []
+    for _ in range(args.events):
+        guild = guilds[random.randint(1, len(guilds))]
+        channel, author = random.choice(list(guild.channels.values())), random.choice(list(guild.members.values()))
+        content = "hey bot, what's up?" if random.random() < args.chat_ratio else f"just chatting {random.random()}"
+        events.append((main.on_message, (FakeMessage(channel, author, content),)))
+    await drive("on_message", events)
+
+async def bench_member_updates(guilds, args):
+    events = []
+    for _ in range(args.events):
+        guild = guilds[random.randint(1, len(guilds))]
+        member = random.choice(list(guild.members.values()))
+        after = FakeMember(guild, member.id); after.nick = random.choice(["badword fan", "normal nick", f"player {member.id}"])
+        events.append((main.on_member_update, (member, after)))
+    await drive("on_member_update", events)
+
+async def bench_quiz(guilds, args):
+    # Each guild plays its rounds in order; a round's latency runs from the correct guess to the
+    # next flag being posted, which is what players wait on.
+    # The stub channels have no REST rate limit, so the outbound queue only coalesces here.
+    main.ROUND_PAUSE_SECONDS, main.SEND_RATE_PERIOD = 0, 0
+    channels = {guild_id: next(iter(guild.channels.values())) for guild_id, guild in guilds.items()}
+    latencies, queries, rss, sends = [], db_query_count(), rss_mib(), sum(channel.sent for channel in channels.values())
+    async def play(guild_id, channel):
+        players = list(guilds[guild_id].members.values())
+        main.active_games[guild_id] = {'channel_id': channel.id}
+        await main.start_new_round(guild_id)
+        for _ in range(args.rounds):
+            await main.on_message(FakeMessage(channel, random.choice(players), "definitely not it"))
+            start = time.perf_counter()
+            await main.on_message(FakeMessage(channel, random.choice(players), main.active_games[guild_id]['answer']))
+            latencies.append(time.perf_counter() - start)
+        game = main.end_game(guild_id)
+        if game and game.get('timer_task'): game['timer_task'].cancel()
+    start = time.perf_counter()
+    await asyncio.gather(*(play(guild_id, channel) for guild_id, channel in channels.items()))
+    await main.flush_user_writes()
+    while any(queue.pending for queue in main.send_queues.values()): await asyncio.sleep(0.05)
+    report("quiz round", len(latencies), time.perf_counter() - start, latencies, db_query_count() - queries, rss_mib() - rss)
+    print(f"  {(sum(channel.sent for channel in channels.values()) - sends) / max(len(latencies), 1):.2f} channel sends/round")
+
+async def bench_giveaways(guilds, args):
+    ended, count, entrants = datetime.utcnow(), args.giveaways, args.entrants
+    rows, entrant_rows = [], []
+    for i in range(count):
+        guild = guilds[i % len(guilds) + 1]
+        channel = next(iter(guild.channels.values()))
+        message = FakeMessage(channel, guild.me, "")
+        message.reactions = [SimpleNamespace(emoji=main.GIVEAWAY_EMOJI, count=entrants + 1, me=True)]
+        channel.messages[message.id] = message
+        rows.append((str(message.id), str(channel.id), str(guild.id), ended, f"Prize {i}", 3))
+        entrant_rows += [(str(message.id), str(user_id)) for user_id in random.sample(list(guild.members), min(entrants, len(guild.members)))]
+        message.reactions[0].count = min(entrants, len(guild.members)) + 1
+    await main.db_executemany("INSERT INTO giveaways (message_id, channel_id, guild_id, end_time, prize, winner_count) VALUES ($1, $2, $3, $4, $5, $6)", rows)
+    await main.db_executemany("INSERT INTO giveaway_entrants (message_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING", entrant_rows)
+    latencies, queries, rss, start = [], db_query_count(), rss_mib(), time.perf_counter()
+    with timed_calls('end_giveaway', latencies):
+        scheduler = asyncio.create_task(main.giveaway_scheduler())
+        while await main.db_fetchval("SELECT COUNT(*) FROM giveaways WHERE is_active = 1 AND end_time <= $1", ended): await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        scheduler.cancel()
+    report(f"giveaway end ({entrants} entrants)", count, elapsed, latencies, db_query_count() - queries, rss_mib() - rss)
+
+async def bench_infections(guilds, args):
+    expired = datetime.utcnow() - timedelta(seconds=1)
+    infected = [(guild, random.choice(list(guild.members))) for guild in guilds.values() for _ in range(args.infections // len(guilds) or 1)]
+    for guild, user_id in infected:
+        await main.update_user_data(guild.id, user_id, 'is_infected', 1)
+        await main.update_user_data(guild.id, user_id, 'infection_expiry', expired)
+    await main.flush_user_writes()
+    await main.reconcile_infections()
+    latencies, queries, rss, start = [], db_query_count(), rss_mib(), time.perf_counter()
+    # Cures are handled in batches, so each cured member is charged the time of its batch.
+    cured = len({(guild.id, user_id) for guild, user_id in infected})
+    with timed_calls('cure_infections', latencies, len):
+        scheduler = asyncio.create_task(main.infection_scheduler())
+        while len(latencies) < cured: await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        scheduler.cancel()
+    report("infection cure", cured, elapsed, latencies, db_query_count() - queries, rss_mib() - rss)
+
+SYNC_BENCHMARKS = {'spam': bench_spam, 'guesses': bench_guesses}
+DB_BENCHMARKS = {'messages': bench_messages, 'member_updates': bench_member_updates, 'quiz': bench_quiz,
+                 'giveaways': bench_giveaways, 'infections': bench_infections}
+
+async def run_db_benchmarks(names, args):
+    stubs = await start_stub_servers()
+    main.http_session = aiohttp.ClientSession()
+    main.COUNTRIES_API_URL = f"{STUB_URL}/countries"
+    main.CHAT_COALESCE_WINDOW = 0.01
+    try:
+        try: await asyncio.wait_for(main.open_database(), 10)
+        except Exception as e:
+            return print(f"Skipping {', '.join(names)}: no Postgres at {os.environ['DB_URL']} ({e}). Set BENCH_DB_URL.")
+        await main.refresh_country_catalog()
+        guilds = build_world(args.guilds, args.users)
+        await main.warm_guild_settings()
+        for name in names:
+            await DB_BENCHMARKS[name](guilds, args)
+    finally:
+        for queue in list(main.send_queues.values()): queue.worker.cancel()
+        await main.flush_user_writes()
+        await main.close_db_pool()
+        await main.http_session.close()
+        await stubs.cleanup()
+        with contextlib.suppress(OSError): os.remove(os.environ['COUNTRY_SNAPSHOT_PATH'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the bot's event handlers.")
+    parser.add_argument('names', nargs='*', metavar='name', help=f"any of: {', '.join([*SYNC_BENCHMARKS, *DB_BENCHMARKS])}")
+    parser.add_argument('--guilds', type=int, default=20)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--giveaways', type=int, default=50)
+    parser.add_argument('--entrants', type=int, default=1000)
+    parser.add_argument('--infections', type=int, default=500)
+    parser.add_argument('--chat-ratio', type=float, default=0.02)
+    args = parser.parse_args()
+    names = args.names or [*SYNC_BENCHMARKS, *DB_BENCHMARKS]
+    unknown = [name for name in names if name not in SYNC_BENCHMARKS and name not in DB_BENCHMARKS]
+    if unknown: parser.error(f"unknown benchmark: {', '.join(unknown)}")
+    for name in names:
+        if name in SYNC_BENCHMARKS: SYNC_BENCHMARKS[name](args)
+    db_names = [name for name in names if name in DB_BENCHMARKS]
+    if db_names: asyncio.run(run_db_benchmarks(db_names, args))
@@ -5,12 +5,22 @@ import aiohttp
 import asyncio
 import random
 import os
-import psycopg2
-import urllib.parse as up
+import asyncpg
 import re
 from datetime import datetime, timedelta
-from groq import Groq
 import json
+import unicodedata
+import time
+import sys
+import signal
+import subprocess
+import heapq
+import functools
+from bisect import bisect_left
+from aiohttp import web
+from array import array
+from collections import OrderedDict, deque
+PROCESS_STARTED = time.monotonic()
 
 # --- Bot Setup ---
 try:
@@ -27,12 +37,24 @@ except ValueError:
 
 
 # --- CHATBOT SYSTEM: Configure the Groq AI ---
-try:
-    groq_client = Groq(api_key=GROQ_API_KEY)
-    print("Groq AI client configured successfully.")
-except Exception as e:
-    print(f"WARNING: Could not configure Groq AI. Chatbot feature will be disabled. Error: {e}")
-    groq_client = None
+# GROQ_BASE_URL is honoured by the client, so it can be pointed at a local fake server.
+GROQ_MODEL = "llama3-8b-8192"
+GROQ_TIMEOUT = float(os.environ.get('GROQ_TIMEOUT', 20))
+groq_client = None
+groq_disabled = False
+
+def get_groq_client():
+    # The SDK is slow to import and construct, so it is loaded on the first chat request rather than at startup.
+    global groq_client, groq_disabled
+    if groq_client is None and not groq_disabled:
+        try:
+            from groq import AsyncGroq
+            groq_client = AsyncGroq(api_key=GROQ_API_KEY, timeout=GROQ_TIMEOUT, max_retries=1)
+            print("Groq AI client configured successfully.")
+        except Exception as e:
+            print(f"WARNING: Could not configure Groq AI. Chatbot feature will be disabled. Error: {e}")
+            groq_disabled = True
+    return groq_client
 
 intents = discord.Intents.default()
 intents.messages = True
@@ -42,274 +64,1218 @@ intents.members = True
 intents.bans = True
 intents.reactions = True
 
-bot = commands.Bot(command_prefix='?', intents=intents, help_command=None)
+# Cluster mode: with CLUSTER_WORKERS > 1 the parent process only supervises that many worker
+# processes, each running an AutoShardedBot over its own slice of SHARD_COUNT gateway shards.
+CLUSTER_WORKERS = int(os.environ.get('CLUSTER_WORKERS', 1))
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT') or CLUSTER_WORKERS)
+SHARD_IDS = [int(i) for i in os.environ['SHARD_IDS'].split(',')] if os.environ.get('SHARD_IDS') else None
+CLUSTER_WORKER_INDEX = int(os.environ.get('CLUSTER_WORKER_INDEX', 0))
+# MEMBER_CACHE_MODE=bounded skips member chunking and the library's member cache; the bot then
+# only remembers members it has recently seen (see the Member Index section).
+MEMBER_CACHE_BOUNDED = os.environ.get('MEMBER_CACHE_MODE', 'full') == 'bounded'
+bot_options = {'command_prefix': '?', 'intents': intents, 'help_command': None}
+if MEMBER_CACHE_BOUNDED: bot_options.update(member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+if SHARD_IDS is not None:
+    bot = commands.AutoShardedBot(**bot_options, shard_ids=SHARD_IDS, shard_count=SHARD_COUNT)
+else:
+    bot = commands.Bot(**bot_options)
+
+def local_guild_ids():
+    # Guilds served by this worker, or None when one process holds every shard.
+    return [str(guild.id) for guild in bot.guilds] if SHARD_IDS is not None else None
+
+# --- Metrics ---
+# A small in-process registry of counters and latency histograms, exposed in Prometheus text
+# format on METRICS_HOST:METRICS_PORT/metrics (off unless METRICS_PORT is set) and via ?botstats.
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.5
+metric_counters = {}
+metric_histograms = {}
+metrics_runner = None
+loop_lag_task = None
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    key = _metric_key(name, labels)
+    metric_counters[key] = metric_counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    # Slots are per-bucket counts with a final +Inf slot, followed by the running sum and count.
+    key = _metric_key(name, labels)
+    hist = metric_histograms.get(key)
+    if hist is None: hist = metric_histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0, 0]
+    hist[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    hist[-2] += seconds; hist[-1] += 1
+
+def histogram_quantile(hist, q):
+    target, seen = q * hist[-1], 0
+    for bound, count in zip((*LATENCY_BUCKETS, float('inf')), hist):
+        seen += count
+        if seen >= target: return bound
+    return float('inf')
+
+def timed_event(handler):
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try: return await handler(*args, **kwargs)
+        finally: observe('arts_event_seconds', time.perf_counter() - start, event=handler.__name__)
+    return wrapper
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    return "{" + ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels) + "}" if labels else ""
+
+def render_metrics():
+    lines = []
+    for name in sorted({name for name, _ in metric_counters}):
+        lines.append(f"# TYPE {name} counter")
+        lines += [f"{name}{_format_labels(labels)} {value}" for (n, labels), value in metric_counters.items() if n == name]
+    for name in sorted({name for name, _ in metric_histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (n, labels), hist in metric_histograms.items():
+            if n != name: continue
+            cumulative = 0
+            for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), hist):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels((*labels, ('le', bound)))} {cumulative}")
+            lines += [f"{name}_sum{_format_labels(labels)} {hist[-2]}", f"{name}_count{_format_labels(labels)} {hist[-1]}"]
+    return "\n".join(lines) + "\n"
+
+async def _metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT: return
+    app = web.Application(); app.router.add_get('/metrics', _metrics_handler)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    try: await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # Metrics are optional; a taken port shouldn't keep the bot offline.
+        print(f"WARNING: Could not start the metrics endpoint on {METRICS_HOST}:{METRICS_PORT}, continuing without it: {e}")
+        await metrics_runner.cleanup(); metrics_runner = None
+        return
+    print(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        observe('arts_event_loop_lag_seconds', max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+def instrument_http(http):
+    request = http.request
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        try: return await request(route, **kwargs)
+        finally: observe('arts_discord_rest_seconds', time.perf_counter() - start, route=f"{route.method} {route.path}")
+    http.request = timed_request
+
+@bot.before_invoke
+async def _start_command_timer(ctx):
+    ctx.metrics_start = time.perf_counter()
+
+@bot.after_invoke
+async def _record_command_time(ctx):
+    if hasattr(ctx, 'metrics_start'):
+        observe('arts_command_seconds', time.perf_counter() - ctx.metrics_start, command=ctx.command.qualified_name, failed=ctx.command_failed)
 
 # --- Permanent Supabase Database Connection ---
-try:
-    up.uses_netloc.append("postgres")
-    url = up.urlparse(DB_URL)
-    conn = psycopg2.connect(
-        database=url.path[1:],
-        user=url.username,
-        password=url.password,
-        host=url.hostname,
-        port=url.port
-    )
-    print("Successfully connected to the permanent Supabase database.")
-except Exception as e:
-    print(f"FATAL ERROR: Could not connect to the database: {e}")
-    exit()
+# All queries go through a bounded asyncpg pool so a slow round-trip to Postgres only
+# suspends the coroutine waiting on it, not the event loop serving every other guild.
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_QUERY_TIMEOUT = float(os.environ.get('DB_QUERY_TIMEOUT', 10))
+DB_CONNECT_RETRIES = 5
+db_pool = None
 
-def init_db():
-    with conn.cursor() as cursor:
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            guild_id TEXT, user_id TEXT, score INTEGER DEFAULT 0, xp INTEGER DEFAULT 0,
-            level INTEGER DEFAULT 0, is_infected INTEGER DEFAULT 0, original_nickname TEXT,
-            infection_expiry TIMESTAMP, spam_offenses INTEGER DEFAULT 0,
-            PRIMARY KEY (guild_id, user_id)
-        )''')
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS guilds (
-            guild_id TEXT PRIMARY KEY, difficulty TEXT DEFAULT 'normal', log_channel TEXT
-        )''')
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS giveaways (
-            message_id TEXT PRIMARY KEY, channel_id TEXT, guild_id TEXT, end_time TIMESTAMP,
-            prize TEXT, winner_count INTEGER, is_active INTEGER DEFAULT 1
-        )''')
-    conn.commit()
-    print("Database tables verified.")
+USER_ROW_QUERY = "SELECT * FROM users WHERE guild_id = $1 AND user_id = $2"
+GUILD_ROW_QUERY = "SELECT * FROM guilds WHERE guild_id = $1"
+PREPARED_QUERIES = {USER_ROW_QUERY: ('', ''), GUILD_ROW_QUERY: ('',)}
+db_ready = None
+
+async def _prepare_statements(connection):
+    # asyncpg keeps a prepared statement per query text on each connection. Running the hottest
+    # reads once with keys that match nothing fills that cache as soon as a pooled connection opens.
+    for query, args in PREPARED_QUERIES.items(): await connection.fetch(query, *args)
+
+async def init_db_pool():
+    global db_pool
+    for attempt in range(1, DB_CONNECT_RETRIES + 1):
+        try:
+            connection = await asyncpg.connect(dsn=DB_URL, timeout=DB_QUERY_TIMEOUT)
+            try: await apply_migrations(connection)
+            finally: await connection.close()
+            db_pool = await asyncpg.create_pool(dsn=DB_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, command_timeout=DB_QUERY_TIMEOUT,
+                                                init=_prepare_statements)
+            print("Successfully connected to the permanent Supabase database.")
+            return
+        except (OSError, asyncpg.PostgresError, asyncio.TimeoutError) as e:
+            print(f"Database connection attempt {attempt}/{DB_CONNECT_RETRIES} failed: {e}")
+            if attempt == DB_CONNECT_RETRIES: raise
+            await asyncio.sleep(2 ** attempt)
+
+def open_database():
+    # Started during login and awaited by the first query; concurrent callers share one attempt.
+    global db_ready
+    if db_ready is None or (db_ready.done() and db_pool is None): db_ready = asyncio.ensure_future(init_db_pool())
+    return asyncio.shield(db_ready)
+
+async def close_db_pool():
+    global db_pool
+    if db_pool: await db_pool.close()
+    db_pool = None
+
+QUERY_TYPE_PATTERN = re.compile(r"^\s*(\w+)\s+(?:.*?\b(?:FROM|INTO|TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ON)\s+)?(\w+)", re.S | re.I)
+query_types = {}
+
+def query_type(query):
+    label = query_types.get(query)
+    if label is None:
+        match = QUERY_TYPE_PATTERN.match(query)
+        label = query_types[query] = f"{match[1].upper()} {match[2]}" if match else query.split(None, 1)[0].upper()
+    return label
+
+async def _db_call(method, query, *args):
+    # Only a failure to get a connection is retried, once. After the statement has been sent it
+    # may already have run, and timeouts would just double the wait, so those errors surface as-is.
+    if db_pool is None: await open_database()
+    start = time.perf_counter()
+    try:
+        for attempt in range(2):
+            try: connection = await db_pool.acquire(timeout=DB_QUERY_TIMEOUT)
+            except (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError) as e:
+                if attempt or isinstance(e, TimeoutError): raise
+                print(f"Could not get a database connection, retrying: {e}")
+                continue
+            try: return await getattr(connection, method)(query, *args, timeout=DB_QUERY_TIMEOUT)
+            finally: await db_pool.release(connection)
+    finally: observe('arts_db_query_seconds', time.perf_counter() - start, query=query_type(query))
+
+async def db_fetch(query, *args): return await _db_call('fetch', query, *args)
+async def db_fetchrow(query, *args): return await _db_call('fetchrow', query, *args)
+async def db_fetchval(query, *args): return await _db_call('fetchval', query, *args)
+async def db_execute(query, *args): return await _db_call('execute', query, *args)
+async def db_executemany(query, args): return await _db_call('executemany', query, args)
+
+# Schema changes are applied once, in order, and recorded in schema_migrations, so restarts and
+# gateway reconnects don't repeat them. The advisory lock stops cluster workers that start
+# together from racing. Append new migrations; never edit one that has shipped.
+SCHEMA_LOCK_ID = 72657301
+MIGRATIONS = [
+    (1, "base tables", '''
+    CREATE TABLE IF NOT EXISTS users (
+        guild_id TEXT, user_id TEXT, score INTEGER DEFAULT 0, xp INTEGER DEFAULT 0,
+        level INTEGER DEFAULT 0, is_infected INTEGER DEFAULT 0, original_nickname TEXT,
+        infection_expiry TIMESTAMP, spam_offenses INTEGER DEFAULT 0,
+        PRIMARY KEY (guild_id, user_id)
+    );
+    CREATE TABLE IF NOT EXISTS guilds (
+        guild_id TEXT PRIMARY KEY, difficulty TEXT DEFAULT 'normal', log_channel TEXT
+    );
+    CREATE TABLE IF NOT EXISTS giveaways (
+        message_id TEXT PRIMARY KEY, channel_id TEXT, guild_id TEXT, end_time TIMESTAMP,
+        prize TEXT, winner_count INTEGER, is_active INTEGER DEFAULT 1
+    );
+    CREATE INDEX IF NOT EXISTS users_infected_expiry_idx ON users (infection_expiry) WHERE is_infected = 1;
+    CREATE INDEX IF NOT EXISTS giveaways_active_end_idx ON giveaways (end_time) WHERE is_active = 1;
+    CREATE TABLE IF NOT EXISTS giveaway_entrants (
+        message_id TEXT, user_id TEXT, PRIMARY KEY (message_id, user_id)
+    )'''),
+    (2, "per-guild moderation settings", '''
+    ALTER TABLE guilds ADD COLUMN IF NOT EXISTS spam_threshold INTEGER, ADD COLUMN IF NOT EXISTS spam_timeframe REAL,
+        ADD COLUMN IF NOT EXISTS banned_words TEXT[]'''),
+    # Per-user score totals across guilds, kept current by a trigger so ?glb reads an index
+    # instead of aggregating the whole users table.
+    (3, "global score totals", '''
+    CREATE TABLE IF NOT EXISTS user_totals (user_id TEXT PRIMARY KEY, total INTEGER NOT NULL DEFAULT 0);
+    CREATE INDEX IF NOT EXISTS user_totals_total_idx ON user_totals (total DESC, user_id);
+    CREATE OR REPLACE FUNCTION sync_user_totals() RETURNS trigger AS $$
+    DECLARE delta INTEGER; uid TEXT;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN delta := COALESCE(NEW.score, 0); uid := NEW.user_id;
+        ELSIF TG_OP = 'DELETE' THEN delta := -COALESCE(OLD.score, 0); uid := OLD.user_id;
+        ELSE delta := COALESCE(NEW.score, 0) - COALESCE(OLD.score, 0); uid := NEW.user_id;
+        END IF;
+        IF delta <> 0 THEN
+            INSERT INTO user_totals (user_id, total) VALUES (uid, delta)
+            ON CONFLICT (user_id) DO UPDATE SET total = user_totals.total + EXCLUDED.total;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS users_sync_totals ON users;
+    CREATE TRIGGER users_sync_totals AFTER INSERT OR DELETE OR UPDATE OF score ON users
+        FOR EACH ROW EXECUTE FUNCTION sync_user_totals();
+    INSERT INTO user_totals (user_id, total)
+    SELECT user_id, SUM(score) FROM users WHERE NOT EXISTS (SELECT 1 FROM user_totals) GROUP BY user_id HAVING SUM(score) <> 0'''),
+    (4, "shared game state", '''
+    CREATE TABLE IF NOT EXISTS game_state (
+        guild_id TEXT, kind TEXT, state JSONB NOT NULL, updated_at TIMESTAMP DEFAULT now(), PRIMARY KEY (guild_id, kind)
+    )'''),
+    # Other bots' reactions are kept (but never drawn) so the entrant count can be checked against the reaction count.
+    (5, "giveaway bot reactors", '''
+    ALTER TABLE giveaway_entrants ADD COLUMN IF NOT EXISTS is_bot BOOLEAN NOT NULL DEFAULT false'''),
+]
+
+async def apply_migrations(connection):
+    async with connection.transaction():
+        await connection.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+        await connection.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, description TEXT, applied_at TIMESTAMP DEFAULT now())")
+        applied = {row[0] for row in await connection.fetch("SELECT version FROM schema_migrations")}
+        for version, description, sql in MIGRATIONS:
+            if version in applied: continue
+            await connection.execute(sql)
+            await connection.execute("INSERT INTO schema_migrations (version, description) VALUES ($1, $2)", version, description)
+            print(f"Applied schema migration {version}: {description}.")
+    print("Database schema is up to date.")
+
+# --- Write-Behind User Stat Buffer ---
+# Column changes are coalesced per (guild, user) and written as one multi-column upsert per
+# batch, so a quiz round costs a fraction of a commit instead of one commit per column. The batch
+# being written stays in inflight_user_writes until it commits, so reads never fall between the two.
+USER_COLUMNS = ('guild_id', 'user_id', 'score', 'xp', 'level', 'is_infected', 'original_nickname', 'infection_expiry', 'spam_offenses')
+USER_WRITE_FLUSH_INTERVAL = 2.0
+USER_WRITE_FLUSH_SIZE = 200
+pending_user_writes = {}
+inflight_user_writes = {}
+user_write_lock = asyncio.Lock()
+
+async def flush_user_writes():
+    global pending_user_writes, inflight_user_writes
+    async with user_write_lock:
+        if not pending_user_writes or not db_pool: return
+        batch, pending_user_writes = pending_user_writes, {}
+        inflight_user_writes = batch
+        by_columns = {}
+        for (g_id, u_id), changes in batch.items():
+            columns = tuple(sorted(changes))
+            by_columns.setdefault(columns, []).append((g_id, u_id, *(changes[c] for c in columns)))
+        start = time.perf_counter()
+        try:
+            async with db_pool.acquire(timeout=DB_QUERY_TIMEOUT) as connection, connection.transaction():
+                for columns, rows in by_columns.items():
+                    placeholders = ", ".join(f"${i}" for i in range(3, len(columns) + 3))
+                    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns)
+                    sql = (f"INSERT INTO users (guild_id, user_id, {', '.join(columns)}) VALUES ($1, $2, {placeholders}) "
+                           f"ON CONFLICT (guild_id, user_id) DO UPDATE SET {updates}")
+                    await connection.executemany(sql, rows, timeout=DB_QUERY_TIMEOUT)
+            observe('arts_db_query_seconds', time.perf_counter() - start, query="FLUSH users")
+            if any('score' in columns for columns in by_columns): global_top_cache['rows'] = None
+        except Exception as e:
+            print(f"Failed to flush {len(batch)} user updates, will retry: {e}")
+            # Changes made while the flush was in flight are newer and must win over the failed batch.
+            for key, changes in pending_user_writes.items(): batch.setdefault(key, {}).update(changes)
+            pending_user_writes = batch
+        finally: inflight_user_writes = {}
+
+# --- Global Leaderboard Aggregate ---
+GLOBAL_TOP_CACHE_SIZE = 100
+GLOBAL_TOP_CACHE_TTL = 60
+global_top_cache = {'rows': None, 'expires': 0.0}
+
+async def get_global_top(page, per_page=10):
+    offset = (page - 1) * per_page
+    if offset + per_page > GLOBAL_TOP_CACHE_SIZE:
+        return await db_fetch("SELECT user_id, total FROM user_totals WHERE total > 0 ORDER BY total DESC, user_id LIMIT $1 OFFSET $2", per_page, offset)
+    if global_top_cache['rows'] is None or global_top_cache['expires'] < time.monotonic():
+        global_top_cache['rows'] = await db_fetch("SELECT user_id, total FROM user_totals WHERE total > 0 ORDER BY total DESC, user_id LIMIT $1", GLOBAL_TOP_CACHE_SIZE)
+        global_top_cache['expires'] = time.monotonic() + GLOBAL_TOP_CACHE_TTL
+    return global_top_cache['rows'][offset:offset + per_page]
+
+@tasks.loop(seconds=USER_WRITE_FLUSH_INTERVAL)
+async def flush_user_writes_task():
+    await flush_user_writes()
 
 # --- Database Helper Functions ---
-def get_user_data(guild_id, user_id):
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT * FROM users WHERE guild_id = %s AND user_id = %s", (str(guild_id), str(user_id)))
-        data = cursor.fetchone()
-        if data is None:
-            cursor.execute("INSERT INTO users (guild_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (str(guild_id), str(user_id)))
-            conn.commit()
-            return str(guild_id), str(user_id), 0, 0, 0, 0, None, None, 0
-    return data
-
-def update_user_data(guild_id, user_id, column, value):
-    with conn.cursor() as cursor:
-        sql = f"INSERT INTO users (guild_id, user_id, {column}) VALUES (%s, %s, %s) ON CONFLICT (guild_id, user_id) DO UPDATE SET {column} = %s;"
-        cursor.execute(sql, (str(guild_id), str(user_id), value, value))
-    conn.commit()
-
-def get_guild_settings(guild_id):
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT * FROM guilds WHERE guild_id = %s", (str(guild_id),))
-        data = cursor.fetchone()
-        if data is None:
-            cursor.execute("INSERT INTO guilds (guild_id) VALUES (%s) ON CONFLICT DO NOTHING", (str(guild_id),))
-            conn.commit()
-            return str(guild_id), 'normal', None
-    return data
-
-def update_guild_settings(guild_id, column, value):
-    with conn.cursor() as cursor:
-        sql = f"INSERT INTO guilds (guild_id, {column}) VALUES (%s, %s) ON CONFLICT (guild_id) DO UPDATE SET {column} = %s;"
-        cursor.execute(sql, (str(guild_id), value, value))
-    conn.commit()
+async def get_user_data(guild_id, user_id):
+    key = (str(guild_id), str(user_id))
+    # A flush may commit while the row is being read, so the batch in flight when the read began is overlaid too.
+    inflight = inflight_user_writes.get(key, {})
+    data = await db_fetchrow(USER_ROW_QUERY, *key)
+    data = list(data) if data is not None else [*key, 0, 0, 0, 0, None, None, 0]
+    for changes in (inflight, inflight_user_writes.get(key, {}), pending_user_writes.get(key, {})):
+        for column, value in changes.items(): data[USER_COLUMNS.index(column)] = value
+    return tuple(data)
+
+async def update_user_data(guild_id, user_id, column, value):
+    pending_user_writes.setdefault((str(guild_id), str(user_id)), {})[column] = value
+    if len(pending_user_writes) >= USER_WRITE_FLUSH_SIZE and not user_write_lock.locked():
+        bot.loop.create_task(flush_user_writes())
+
+# Guild settings change rarely and are read on every round start and nickname check, so they
+# are served from a bounded LRU cache that is warmed at startup and updated write-through.
+GUILD_SETTINGS_CACHE_SIZE = 10000
+guild_settings_cache = OrderedDict()
+
+def _cache_guild_settings(row):
+    guild_settings_cache[row[0]] = tuple(row)
+    guild_settings_cache.move_to_end(row[0])
+    while len(guild_settings_cache) > GUILD_SETTINGS_CACHE_SIZE: guild_settings_cache.popitem(last=False)
+    return guild_settings_cache[row[0]]
+
+async def get_guild_settings(guild_id):
+    cached = guild_settings_cache.get(str(guild_id))
+    inc('arts_cache_requests_total', cache='guild_settings', result='hit' if cached is not None else 'miss')
+    if cached is not None:
+        guild_settings_cache.move_to_end(str(guild_id))
+        return cached
+    data = await db_fetchrow(GUILD_ROW_QUERY, str(guild_id))
+    if data is None:
+        await db_execute("INSERT INTO guilds (guild_id) VALUES ($1) ON CONFLICT DO NOTHING", str(guild_id))
+        data = (str(guild_id), 'normal', None, None, None, None)
+    return _cache_guild_settings(data)
+
+async def update_guild_settings(guild_id, column, value):
+    sql = f"INSERT INTO guilds (guild_id, {column}) VALUES ($1, $2) ON CONFLICT (guild_id) DO UPDATE SET {column} = $2 RETURNING *;"
+    _cache_guild_settings(await db_fetchrow(sql, str(guild_id), value))
+
+# Banned words are edited in place in SQL, so concurrent ?banword calls can't overwrite each
+# other. Each returns the new settings, or None when nothing changed.
+async def add_guild_banned_word(guild_id, word, limit):
+    row = await db_fetchrow("INSERT INTO guilds (guild_id, banned_words) VALUES ($1, ARRAY[$2]) ON CONFLICT (guild_id) DO UPDATE "
+                            "SET banned_words = array_append(COALESCE(guilds.banned_words, '{}'), $2) "
+                            "WHERE NOT $2 = ANY(COALESCE(guilds.banned_words, '{}')) AND cardinality(COALESCE(guilds.banned_words, '{}')) < $3 RETURNING *",
+                            str(guild_id), word, limit)
+    return _cache_guild_settings(row) if row else None
+
+async def remove_guild_banned_word(guild_id, word):
+    row = await db_fetchrow("UPDATE guilds SET banned_words = NULLIF(array_remove(banned_words, $2), '{}') "
+                            "WHERE guild_id = $1 AND $2 = ANY(banned_words) RETURNING *", str(guild_id), word)
+    return _cache_guild_settings(row) if row else None
 
 # --- System Setups ---
-user_message_timestamps = {}
 SPAM_THRESHOLD = 5
 SPAM_TIMEFRAME = 2.5
 BANNED_WORDS = ["inappropriate", "badword", "example"]
+MAX_GUILD_BANNED_WORDS = 5000
+TRIGGER_WORDS = ["bot", "arts", "arts automation"]
+TRIGGER_PREFIXES = ("!arts",)
+TRIGGER_PATTERN = re.compile("|".join(re.escape(w.lower()) for w in sorted(TRIGGER_WORDS, key=len, reverse=True)))
 active_games = {}
 
+# --- Spam Rate Limiter ---
+class SpamLimiter:
+    """Sliding-window message counter keyed by (guild, user).
+
+    Each entry is a ring of the last `threshold` timestamps, so a message trips the limit exactly
+    when the timestamp it overwrites is still inside the window: one compare and one store, no
+    list rebuild. Entries are kept in activity order and dropped once idle past the window.
+    """
+    def __init__(self, threshold=SPAM_THRESHOLD, timeframe=SPAM_TIMEFRAME, max_entries=200000):
+        self.threshold, self.timeframe, self.max_entries = threshold, timeframe, max_entries
+        self.max_timeframe = timeframe
+        self.guild_limits = {}
+        self.windows = OrderedDict()
+
+    def set_guild_limits(self, guild_id, threshold, timeframe):
+        self.guild_limits[guild_id] = (threshold, timeframe)
+        self.max_timeframe = max(self.max_timeframe, timeframe)
+
+    def hit(self, guild_id, user_id, now):
+        threshold, timeframe = self.guild_limits.get(guild_id, (self.threshold, self.timeframe))
+        key = (guild_id, user_id)
+        entry = self.windows.get(key)
+        if entry is None or len(entry[1]) != threshold:
+            entry = self.windows[key] = [0, array('d', [float('-inf')]) * threshold]
+        self.windows.move_to_end(key)
+        index, ring = entry
+        tripped = now - ring[index] < timeframe
+        if tripped: del self.windows[key]
+        else: ring[index] = now; entry[0] = (index + 1) % threshold
+        self._evict(now)
+        return tripped
+
+    def _evict(self, now):
+        windows = self.windows
+        while windows:
+            key, (index, ring) = next(iter(windows.items()))
+            if len(windows) <= self.max_entries and now - ring[index - 1] < self.max_timeframe: break
+            del windows[key]
+
+spam_limiter = SpamLimiter()
+
+# --- Banned Word Matcher ---
+class WordMatcher:
+    """Aho-Corasick automaton over lowercased words.
+
+    A scan walks the text once, so the cost of a check depends on the text length and not on how
+    many words are banned. Changes only mark the automaton stale; it is rebuilt on the next check.
+    """
+    def __init__(self, words=()):
+        self.words = {w.lower().strip() for w in words if w.strip()}
+        self._goto = None
+
+    def add(self, word):
+        word = word.lower().strip()
+        if word and word not in self.words: self.words.add(word); self._goto = None
+
+    def remove(self, word):
+        word = word.lower().strip()
+        if word in self.words: self.words.discard(word); self._goto = None
+
+    def _build(self):
+        goto, output = [{}], [False]
+        for word in self.words:
+            node = 0
+            for ch in word:
+                if ch not in goto[node]:
+                    goto[node][ch] = len(goto); goto.append({}); output.append(False)
+                node = goto[node][ch]
+            output[node] = True
+        fail, queue = [0] * len(goto), deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in goto[node].items():
+                queue.append(child)
+                f = fail[node]
+                while f and ch not in goto[f]: f = fail[f]
+                fail[child] = goto[f].get(ch, 0) if node else 0
+                output[child] = output[child] or output[fail[child]]
+        self._goto, self._fail, self._output = goto, fail, output
+
+    def search(self, text):
+        if self._goto is None: self._build()
+        goto, fail, output, node = self._goto, self._fail, self._output, 0
+        for ch in text.lower():
+            while node and ch not in goto[node]: node = fail[node]
+            node = goto[node].get(ch, 0)
+            if output[node]: return True
+        return False
+
+default_word_matcher = WordMatcher(BANNED_WORDS)
+guild_word_matchers = {}
+
+def word_matcher_for(guild_id):
+    return guild_word_matchers.get(guild_id, default_word_matcher)
+
+def set_guild_banned_words(guild_id, words):
+    if words: guild_word_matchers[guild_id] = WordMatcher([*BANNED_WORDS, *words])
+    else: guild_word_matchers.pop(guild_id, None)
+
+def guild_word_matcher(guild_id):
+    # The guild's own matcher, created on its first custom word; edits then go through add/remove.
+    matcher = guild_word_matchers.get(guild_id)
+    if matcher is None: matcher = guild_word_matchers[guild_id] = WordMatcher(BANNED_WORDS)
+    return matcher
+
+async def warm_guild_settings():
+    guild_ids = [str(guild.id) for guild in bot.guilds]
+    for row in await db_fetch("SELECT * FROM guilds WHERE guild_id = ANY($1::text[])", guild_ids):
+        if len(guild_settings_cache) < GUILD_SETTINGS_CACHE_SIZE: _cache_guild_settings(row)
+        g_id, threshold, timeframe, banned_words = int(row['guild_id']), row['spam_threshold'], row['spam_timeframe'], row['banned_words']
+        if threshold is not None and timeframe is not None: spam_limiter.set_guild_limits(g_id, threshold, timeframe)
+        if banned_words: set_guild_banned_words(g_id, banned_words)
+
+# --- Country Catalog ---
+# restcountries is fetched once and bucketed by difficulty, then refreshed on a TTL. A JSON
+# snapshot on disk covers cold starts and restcountries outages.
+COUNTRIES_API_URL = 'https://restcountries.com/v3.1/all?fields=name,altSpellings,flags,population'
+COUNTRY_SNAPSHOT_PATH = os.environ.get('COUNTRY_SNAPSHOT_PATH', 'countries_snapshot.json')
+COUNTRY_CATALOG_TTL = 24 * 3600
+DIFFICULTY_POPULATION = {'easy': 15000000, 'normal': 1000000, 'hard': 0}
+http_session = None
+country_buckets = {}
+catalog_answer_keys = {}
+country_catalog_loaded_at = 0.0
+
+def _set_country_catalog(countries, loaded_at):
+    global country_buckets, catalog_answer_keys, country_catalog_loaded_at
+    valid_countries = [c for c in countries if 'common' in c.get('name', {}) and 'png' in c.get('flags', {})]
+    country_buckets = {d: [c for c in valid_countries if c.get('population', 0) > p] for d, p in DIFFICULTY_POPULATION.items()}
+    catalog_answer_keys = index_answer_keys(valid_countries)
+    country_catalog_loaded_at = loaded_at
+
+def _read_country_snapshot():
+    try:
+        with open(COUNTRY_SNAPSHOT_PATH, encoding='utf-8') as f: return json.load(f), os.path.getmtime(COUNTRY_SNAPSHOT_PATH)
+    except (OSError, ValueError): return None, 0.0
+
+def _write_country_snapshot(countries):
+    tmp_path = f"{COUNTRY_SNAPSHOT_PATH}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(countries, f)
+    os.replace(tmp_path, COUNTRY_SNAPSHOT_PATH)
+
+async def load_country_catalog():
+    countries, loaded_at = await asyncio.to_thread(_read_country_snapshot)
+    if countries:
+        _set_country_catalog(countries, loaded_at)
+        print(f"Loaded {len(countries)} countries from snapshot.")
+
+async def refresh_country_catalog():
+    try:
+        async with http_session.get(COUNTRIES_API_URL, timeout=aiohttp.ClientTimeout(total=30)) as response:
+            response.raise_for_status()
+            countries = await response.json()
+    except Exception as e:
+        print(f"Could not refresh country catalog: {e}")
+        return False
+    _set_country_catalog(countries, datetime.utcnow().timestamp())
+    try: await asyncio.to_thread(_write_country_snapshot, countries)
+    except OSError as e: print(f"Could not write country snapshot: {e}")
+    return True
+
+@tasks.loop(hours=1)
+async def refresh_country_catalog_task():
+    if not country_buckets or datetime.utcnow().timestamp() - country_catalog_loaded_at > COUNTRY_CATALOG_TTL:
+        await refresh_country_catalog()
+
+# --- Answer Matching ---
+# Each round accepts the country's common, official and alternative names, except two-letter codes. Names and guesses
+# are reduced to a key: case- and accent-folded, a leading "the" dropped, and everything but
+# letters and digits removed. A guess is then one key and one set lookup, plus a bounded
+# edit-distance check against the handful of accepted keys to forgive small typos. A typo is
+# only forgiven when no other country's name is as close, so "Zambia" never passes for Gambia.
+ASCII_PUNCTUATION = bytes(c for c in range(128) if not chr(c).isalnum())
+
+def answer_key(text):
+    text = text.casefold().replace('&', 'and').lstrip()
+    if text.startswith('the '): text = text[4:]
+    if text.isascii(): return text.encode().translate(None, ASCII_PUNCTUATION).decode()
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if c.isalnum() and not unicodedata.combining(c))
+
+def answer_keys(country):
+    # altSpellings always lead with the ISO alpha-2 code, and "no", "it" or "in" said in chat must not win a round.
+    alternatives = [key for key in map(answer_key, country.get('altSpellings', ())) if len(key) > 2]
+    names = [country['name']['common'], country['name'].get('official', '')]
+    return frozenset(key for key in [*map(answer_key, names), *alternatives] if key)
+
+def index_answer_keys(countries):
+    # Every accepted key in the catalog, grouped by length for the rival check in is_correct_guess.
+    by_length = {}
+    for country in countries:
+        for key in answer_keys(country): by_length.setdefault(len(key), set()).add(key)
+    return {length: frozenset(keys) for length, keys in by_length.items()}
+
+def typo_limit(length):
+    return 0 if length < 5 else 1 if length < 10 else 2
+
+def within_edit_distance(a, b, limit):
+    # Levenshtein restricted to the diagonal band |i - j| <= limit; cells outside it can't be within the limit.
+    if abs(len(a) - len(b)) > limit: return False
+    far = limit + 1
+    previous = [j if j <= limit else far for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, 1):
+        lo, hi = max(1, i - limit), min(len(b), i + limit)
+        current = [i if i <= limit else far] + [far] * len(b)
+        for j in range(lo, hi + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != b[j - 1]))
+        if min(current[lo - 1:hi + 1]) > limit: return False
+        previous = current
+    return previous[-1] <= limit
+
+def is_correct_guess(guess, answers):
+    key = answer_key(guess)
+    if key in answers: return True
+    if not key or key in catalog_answer_keys.get(len(key), ()): return False
+    distance = next((d for d in (1, 2) if any(typo_limit(len(answer)) >= d and within_edit_distance(key, answer, d) for answer in answers)), None)
+    if distance is None: return False
+    rivals = (other for length in range(len(key) - distance, len(key) + distance + 1) for other in catalog_answer_keys.get(length, ()) if other not in answers)
+    return not any(within_edit_distance(key, other, distance) for other in rivals)
+
+def answer_keys_for_name(name):
+    country = next((c for c in country_buckets.get('hard', ()) if c['name']['common'] == name), None)
+    return answer_keys(country) if country else frozenset({answer_key(name)})
+
+# --- Shared Game State ---
+# Quiz rounds and start votes are mirrored to a shared store so a guild's game survives its
+# shard moving to another worker or a worker restarting. Tasks and prepared rounds stay local.
+# A single process has no one to share with, so it defaults to the in-memory store and a correct
+# guess costs no extra commits; set GAME_STATE_BACKEND=postgres to survive plain restarts too.
+GAME_STATE_BACKEND = os.environ.get('GAME_STATE_BACKEND') or ('postgres' if CLUSTER_WORKERS > 1 or SHARD_IDS is not None else 'memory')
+
+class PostgresGameStore:
+    async def put(self, guild_id, kind, state):
+        await db_execute("INSERT INTO game_state (guild_id, kind, state) VALUES ($1, $2, $3::jsonb) "
+                         "ON CONFLICT (guild_id, kind) DO UPDATE SET state = EXCLUDED.state, updated_at = now()",
+                         str(guild_id), kind, json.dumps(state))
+
+    async def drop(self, guild_id, kind):
+        await db_execute("DELETE FROM game_state WHERE guild_id = $1 AND kind = $2", str(guild_id), kind)
+
+    async def load(self, guild_ids=None):
+        rows = await db_fetch("SELECT guild_id, kind, state FROM game_state WHERE $1::text[] IS NULL OR guild_id = ANY($1::text[])", guild_ids)
+        return {(int(g_id), kind): json.loads(state) for g_id, kind, state in rows}
+
+class MemoryGameStore:
+    def __init__(self): self.states = {}
+    async def put(self, guild_id, kind, state): self.states[(int(guild_id), kind)] = state
+    async def drop(self, guild_id, kind): self.states.pop((int(guild_id), kind), None)
+    async def load(self, guild_ids=None):
+        wanted = None if guild_ids is None else {int(g_id) for g_id in guild_ids}
+        return {key: state for key, state in self.states.items() if wanted is None or key[0] in wanted}
+
+game_store = MemoryGameStore() if GAME_STATE_BACKEND == 'memory' else PostgresGameStore()
+
+async def save_state(guild_id, kind, state=None):
+    # Losing a mirror write only costs recovery after a crash, so it never fails the game itself.
+    try:
+        if state is None: await game_store.drop(guild_id, kind)
+        else: await game_store.put(guild_id, kind, state)
+    except Exception as e: print(f"Could not save {kind} state for guild {guild_id}: {e}")
+
+async def restore_game_state():
+    try: states = await game_store.load(local_guild_ids())
+    except Exception as e: return print(f"Could not load shared game state: {e}")
+    for (guild_id, kind), state in states.items():
+        channel = bot.get_channel(state['channel_id'])
+        if not channel or (SHARD_IDS is not None and not bot.get_guild(guild_id)): continue
+        if kind == 'vote':
+            # A vote's waiter died with the old process, so close it out rather than leave it hanging.
+            await save_state(guild_id, 'vote')
+            try:
+                vote_msg = await channel.fetch_message(state['message_id'])
+                await vote_msg.edit(embed=discord.Embed(title="Vote Interrupted", description="The bot restarted. Please run `?flagstart` again.", color=discord.Color.gold()))
+            except discord.HTTPException: pass
+        elif kind == 'game' and guild_id not in active_games:
+            active_games[guild_id] = {'channel_id': state['channel_id'], 'answer': state.get('answer')}
+            if state.get('answer'): active_games[guild_id]['answers'] = answer_keys_for_name(state['answer'])
+            if not state.get('answer'):
+                bot.loop.create_task(start_new_round(guild_id)); continue
+            remaining = state['round_ends_at'] - time.time()
+            active_games[guild_id]['timer_task'] = bot.loop.create_task(round_timer(guild_id, max(0, remaining)))
+            preload_next_round(guild_id)
+    print(f"Restored {sum(kind == 'game' for _, kind in states)} game(s) from the shared store.")
+
+# --- Outbound Message Queue ---
+# Game announcements go through one queue per channel. Messages queued within a short window
+# are merged into a single send (lines joined, up to 10 embeds), sends are paced under the
+# channel's 5-per-5s bucket, and producers wait once a channel has SEND_QUEUE_LIMIT queued.
+SEND_COALESCE_WINDOW = 0.2
+SEND_RATE_LIMIT = 5
+SEND_RATE_PERIOD = 5.0
+SEND_QUEUE_LIMIT = 25
+SEND_QUEUE_IDLE = 30
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_MESSAGE_LENGTH = 2000
+send_queues = {}
+
+class ChannelSendQueue:
+    def __init__(self, channel):
+        self.channel = channel
+        self.pending = deque()
+        self.capacity = asyncio.Semaphore(SEND_QUEUE_LIMIT)
+        self.wakeup = asyncio.Event()
+        self.sent_at = deque(maxlen=SEND_RATE_LIMIT)
+        self.worker = bot.loop.create_task(self.run())
+
+    async def put(self, item):
+        await self.capacity.acquire()
+        self.pending.append(item)
+        self.wakeup.set()
+
+    def take(self):
+        self.capacity.release()
+        return self.pending.popleft()
+
+    def take_batch(self):
+        # Items merge while they all allow it and the result still fits in one message.
+        content, embeds, merge, future = first = self.take()
+        batch, length, embed_count = [first], len(content or ''), len(embeds)
+        while merge and self.pending:
+            content, embeds, merge, future = self.pending[0]
+            if not merge or embed_count + len(embeds) > MAX_EMBEDS_PER_MESSAGE or length + len(content or '') + 1 > MAX_MESSAGE_LENGTH: break
+            batch.append(self.take()); length += len(content or '') + 1; embed_count += len(embeds)
+        return batch
+
+    async def run(self):
+        try:
+            while True:
+                if not self.pending:
+                    self.wakeup.clear()
+                    try: await asyncio.wait_for(self.wakeup.wait(), SEND_QUEUE_IDLE)
+                    except asyncio.TimeoutError:
+                        if not self.pending: return
+                if self.pending[0][2]: await asyncio.sleep(SEND_COALESCE_WINDOW)
+                if len(self.sent_at) == SEND_RATE_LIMIT:
+                    await asyncio.sleep(max(0, self.sent_at[0] + SEND_RATE_PERIOD - time.monotonic()))
+                batch = self.take_batch()
+                kwargs = {'content': "\n".join(content for content, *_ in batch if content) or None}
+                embeds = [embed for _, item_embeds, *_ in batch for embed in item_embeds]
+                if embeds: kwargs['embeds'] = embeds
+                self.sent_at.append(time.monotonic())
+                inc('arts_outbound_messages_total', len(batch), sent='merged' if len(batch) > 1 else 'single')
+                futures = [future for *_, future in batch if future and not future.done()]
+                try: sent = await self.channel.send(**kwargs)
+                except Exception as e:
+                    print(f"Queued send to channel {self.channel.id} failed: {e}")
+                    for future in futures: future.set_exception(e)
+                else:
+                    for future in futures: future.set_result(sent)
+        finally:
+            if send_queues.get(self.channel.id) is self: del send_queues[self.channel.id]
+
+async def queue_send(channel, content=None, *, embed=None, merge=True, wait=False):
+    # Returns once the message is queued, or once it is sent when wait=True. merge=False keeps a
+    # message on its own, e.g. pings where each one is meant to notify.
+    queue = send_queues.get(channel.id)
+    if queue is None: queue = send_queues[channel.id] = ChannelSendQueue(channel)
+    future = bot.loop.create_future() if wait else None
+    await queue.put((content, [embed] if embed is not None else [], merge, future))
+    if future: return await future
+
 # --- Game Helper Functions ---
 async def get_random_country(difficulty="normal"):
-    population_filter = 0
-    if difficulty == "easy": population_filter = 15000000
-    elif difficulty == "normal": population_filter = 1000000
+    if not country_buckets: await refresh_country_catalog()
+    valid_countries = country_buckets.get(difficulty) or country_buckets.get('hard')
+    return random.choice(valid_countries) if valid_countries else None
+
+ROUND_PAUSE_SECONDS = 3
+
+async def _warm_flag_image(url):
+    # Pulls the flag through the CDN edge ahead of Discord's media proxy asking for it.
     try:
-        async with aiohttp.ClientSession() as session:
-            api_url = 'https://restcountries.com/v3.1/all?fields=name,flags,population'
-            async with session.get(api_url) as response:
-                if response.status == 200:
-                    countries = await response.json()
-                    valid_countries = [c for c in countries if 'common' in c.get('name', {}) and 'png' in c.get('flags', {}) and c.get('population', 0) > population_filter]
-                    return random.choice(valid_countries) if valid_countries else None
-    except: return None
+        async with http_session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response: await response.read()
+    except Exception: pass
 
-async def start_new_round(guild_id):
-    if guild_id not in active_games: return
-    channel = bot.get_channel(active_games[guild_id]['channel_id'])
-    if not channel: return active_games.pop(guild_id, None)
-    settings = get_guild_settings(guild_id)
+async def prepare_round(guild_id):
+    settings = await get_guild_settings(guild_id)
     country = await get_random_country(settings[1])
-    if not country: return await channel.send(f"Could not fetch a new flag. Please try again later.")
-    active_games[guild_id]['answer'] = country['name']['common']
+    if not country: return None
     embed = discord.Embed(title="Guess the Flag!", description="Type the name of the country! You have 60 seconds.", color=discord.Color.blue())
     embed.set_image(url=country['flags']['png'])
-    await channel.send(embed=embed)
-    active_games[guild_id]['timer_task'] = bot.loop.create_task(round_timer(guild_id, 60))
+    bot.loop.create_task(_warm_flag_image(country['flags']['png']))
+    return {'difficulty': settings[1], 'country': country, 'answers': answer_keys(country), 'embed': embed}
+
+def preload_next_round(guild_id):
+    if guild_id in active_games and not active_games[guild_id].get('next_round'):
+        active_games[guild_id]['next_round'] = bot.loop.create_task(prepare_round(guild_id))
+
+def end_game(guild_id):
+    game = active_games.pop(guild_id, None)
+    if game and game.get('next_round'): game['next_round'].cancel()
+    if game: bot.loop.create_task(save_state(guild_id, 'game'))
+    return game
+
+async def start_new_round(guild_id):
+    game = active_games.get(guild_id)
+    if not game: return
+    channel = bot.get_channel(game['channel_id'])
+    if not channel: return end_game(guild_id)
+    # Each call owns a round number, so a skip or stop while this one awaits makes it back off.
+    # Nothing can be guessed until the flag is up.
+    game['round'] = round_id = game.get('round', 0) + 1
+    game['answer'] = None
+    def superseded(): return active_games.get(guild_id) is not game or game['round'] != round_id
+    next_round, round_data = game.pop('next_round', None), None
+    if next_round:
+        try: round_data = await next_round
+        except Exception as e: print(f"Preloading next round failed: {e}")
+    settings = await get_guild_settings(guild_id)
+    if not round_data or round_data['difficulty'] != settings[1]: round_data = await prepare_round(guild_id)
+    if superseded(): return
+    if not round_data: return await queue_send(channel, "Could not fetch a new flag. Please try again later.")
+    # The 60 seconds start once the flag is actually posted, not when it joins the channel's queue.
+    try: await queue_send(channel, embed=round_data['embed'], wait=True)
+    except Exception:
+        if not superseded(): end_game(guild_id)
+        return
+    if superseded(): return
+    game['answer'] = round_data['country']['name']['common']
+    game['answers'] = round_data['answers']
+    if game.get('timer_task'): game['timer_task'].cancel()
+    game['timer_task'] = bot.loop.create_task(round_timer(guild_id, 60))
+    preload_next_round(guild_id)
+    if guild_id in active_games: await save_state(guild_id, 'game', {'channel_id': channel.id, 'answer': active_games[guild_id]['answer'], 'round_ends_at': time.time() + 60})
 
 async def round_timer(guild_id, seconds):
     await asyncio.sleep(seconds)
-    if guild_id in active_games:
-        game = active_games.pop(guild_id, None)
+    # Only the round's current timer may end the game; one that was replaced just lapses.
+    if guild_id in active_games and active_games[guild_id].get('timer_task') is asyncio.current_task():
+        game = end_game(guild_id)
         if game and bot.get_channel(game['channel_id']):
             channel = bot.get_channel(game['channel_id'])
-            await channel.send(f"Time's up! The answer was **{game['answer']}**. Game has ended.")
+            await queue_send(channel, f"Time's up! The answer was **{game['answer']}**. Game has ended.")
             await leaderboard(channel, guild_id)
 
+# --- Display Name Resolver ---
+# Leaderboard names come from the gateway cache first, then a TTL+LRU cache, and only the
+# remainder is fetched over REST, concurrently but capped so a cold board can't trip a 429.
+NAME_CACHE_TTL = 3600
+NAME_CACHE_SIZE = 10000
+NAME_FETCH_CONCURRENCY = 4
+display_name_cache = OrderedDict()
+name_fetch_semaphore = asyncio.Semaphore(NAME_FETCH_CONCURRENCY)
+
+async def _fetch_display_name(user_id):
+    async with name_fetch_semaphore:
+        try: name = (await bot.fetch_user(user_id)).display_name
+        except discord.NotFound: name = "Unknown User"
+        except discord.HTTPException: return "Unknown User"
+    display_name_cache[user_id] = (name, time.monotonic() + NAME_CACHE_TTL)
+    display_name_cache.move_to_end(user_id)
+    while len(display_name_cache) > NAME_CACHE_SIZE: display_name_cache.popitem(last=False)
+    return name
+
+async def resolve_display_names(user_ids, guild=None):
+    names, missing, now = {}, [], time.monotonic()
+    for user_id in user_ids:
+        user = (guild.get_member(user_id) if guild else None) or bot.get_user(user_id)
+        seen = recent_members.get(guild.id, {}).get(user_id) if guild else None
+        cached = display_name_cache.get(user_id)
+        if user: names[user_id] = user.display_name
+        elif seen: names[user_id] = seen[1]
+        elif cached and cached[1] > now:
+            display_name_cache.move_to_end(user_id); names[user_id] = cached[0]
+        else: missing.append(user_id)
+    inc('arts_cache_requests_total', len(names), cache='display_names', result='hit')
+    inc('arts_cache_requests_total', len(missing), cache='display_names', result='miss')
+    for user_id, name in zip(missing, await asyncio.gather(*map(_fetch_display_name, missing))): names[user_id] = name
+    return names
+
 async def leaderboard(channel, guild_id):
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT user_id, score FROM users WHERE guild_id = %s AND score > 0 ORDER BY score DESC LIMIT 10", (str(guild_id),))
-        server_top = cursor.fetchall()
-    if not server_top: return await channel.send("Leaderboard is empty.")
+    await flush_user_writes()
+    server_top = await db_fetch("SELECT user_id, score FROM users WHERE guild_id = $1 AND score > 0 ORDER BY score DESC LIMIT 10", str(guild_id))
+    if not server_top: return await queue_send(channel, "Leaderboard is empty.")
     embed = discord.Embed(title=f"Leaderboard for {channel.guild.name}", color=discord.Color.gold())
-    desc = ""
+    desc, names = "", await resolve_display_names([int(user_id) for user_id, _ in server_top], channel.guild)
     for i, (user_id, score) in enumerate(server_top):
-        try: user_name = (await bot.fetch_user(int(user_id))).display_name
-        except: user_name = f"Unknown User"
+        user_name = names[int(user_id)]
         emoji = ["🥇", "🥈", "🥉"][i] if i < 3 else "🔹"
         desc += f"{emoji} **{user_name}**: {score} points\n"
     embed.description = desc
-    await channel.send(embed=embed)
+    await queue_send(channel, embed=embed)
+
+# --- LLM Request Pipeline ---
+# Chat triggers in a channel are debounced: a newer trigger cancels the pending reply, so a
+# burst of messages gets one reply built from the full burst. Calls are capped globally and
+# per guild so one chatty server cannot hold every Groq slot.
+GROQ_GLOBAL_CONCURRENCY = 8
+GROQ_GUILD_CONCURRENCY = 2
+CHAT_COALESCE_WINDOW = 1.5
+groq_semaphore = asyncio.Semaphore(GROQ_GLOBAL_CONCURRENCY)
+guild_groq_semaphores = {}
+chat_tasks = {}
+
+async def groq_complete(guild_id, messages):
+    guild_semaphore = guild_groq_semaphores.setdefault(guild_id, asyncio.Semaphore(GROQ_GUILD_CONCURRENCY))
+    async with guild_semaphore, groq_semaphore:
+        start = time.perf_counter()
+        client = get_groq_client()
+        if client is None: raise RuntimeError("Groq AI is not configured")
+        try: chat_completion = await asyncio.wait_for(client.chat.completions.create(messages=messages, model=GROQ_MODEL), GROQ_TIMEOUT)
+        except Exception as e:
+            inc('arts_groq_errors_total', error=type(e).__name__)
+            raise
+        finally: observe('arts_groq_request_seconds', time.perf_counter() - start)
+    return chat_completion.choices[0].message.content
+
+def schedule_chat_reply(message):
+    channel_id = message.channel.id
+    previous = chat_tasks.get(channel_id)
+    if previous and not previous.done(): previous.cancel()
+    task = chat_tasks[channel_id] = bot.loop.create_task(chat_reply(message))
+    task.add_done_callback(lambda t: chat_tasks.pop(channel_id) if chat_tasks.get(channel_id) is t else None)
+
+# --- Owner Command Parser ---
+# Owner messages are classified locally first: without both a user reference and a count they
+# can only be chat, and "ping <user> <n>" is parsed directly. Only what's left goes to the LLM,
+# whose verdicts are kept in an LRU keyed by normalized content.
+OWNER_PARSER_PROMPT = ("You are a command parser. Analyze the user's request. The only command is 'ping'. "
+                       "A ping request must have a user mention/ID and a number. "
+                       "If it is a valid ping command, output ONLY a JSON object like: "
+                       "`{\"command\": \"ping\", \"user_id\": \"<user_id>\", \"amount\": <number>}`. "
+                       "Extract the numerical ID from the mention. For any other request, output ONLY: `{\"command\": \"chat\"}`.")
+PING_USER_PATTERN = re.compile(r"<@!?(\d{15,21})>|\b(\d{15,21})\b")
+PING_COUNT_PATTERN = re.compile(r"(?<!\d)\d{1,4}(?!\d)")
+COUNT_WORDS = frozenset("once twice thrice one two three four five six seven eight nine ten dozen few couple".split())
+# Matched against the lowercased message with punctuation dropped and the user reference replaced by "@u".
+OBVIOUS_PING_PATTERNS = (re.compile(r"^(?:please )?ping @u (?:x ?)?(\d{1,4})(?: ?(?:x|times?))?(?: please)?$"),
+                         re.compile(r"^(?:please )?ping (?:x ?)?(\d{1,4})(?: ?(?:x|times?))? @u(?: please)?$"))
+OWNER_PARSER_CACHE_SIZE = 256
+owner_parser_cache = OrderedDict()
+
+def parse_owner_command(content, self_id=None):
+    # Returns the command, or None when the message needs the LLM to decide. Mentions of the
+    # bot itself (how the owner usually addresses it) are not ping targets.
+    if self_id: content = content.replace(f"<@{self_id}>", ' ').replace(f"<@!{self_id}>", ' ')
+    users = {int(mention or raw_id) for mention, raw_id in PING_USER_PATTERN.findall(content)}
+    text = ' '.join(re.sub(r"[^\w@]", ' ', PING_USER_PATTERN.sub(' @u ', content.lower())).split())
+    if not users or not (PING_COUNT_PATTERN.search(text) or COUNT_WORDS.intersection(text.split())): return {'command': 'chat'}
+    match = len(users) == 1 and next(filter(None, (pattern.match(text) for pattern in OBVIOUS_PING_PATTERNS)), None)
+    return {'command': 'ping', 'user_id': users.pop(), 'amount': int(match[1])} if match else None
+
+async def parse_owner_command_llm(message):
+    key = ' '.join(message.content.lower().split())
+    cached = owner_parser_cache.get(key)
+    inc('arts_cache_requests_total', cache='owner_parser', result='hit' if cached is not None else 'miss')
+    if cached is not None:
+        owner_parser_cache.move_to_end(key)
+        return cached
+    # The raw content keeps mentions as <@id>, so the model can actually read the ID out of them.
+    response_text = await groq_complete(message.guild.id, [{"role": "system", "content": OWNER_PARSER_PROMPT}, {"role": "user", "content": message.content}])
+    parsed = owner_parser_cache[key] = json.loads(response_text.strip('` \njson'))
+    while len(owner_parser_cache) > OWNER_PARSER_CACHE_SIZE: owner_parser_cache.popitem(last=False)
+    return parsed
+
+# --- Channel Context Buffer ---
+# Recent messages per channel are kept from the on_message stream, so building chat context
+# needs no REST call. Idle channels are evicted LRU-first once CONTEXT_MAX_CHANNELS is hit.
+CONTEXT_HISTORY_SIZE = 10
+CONTEXT_MAX_CHANNELS = 2000
+CONTEXT_MAX_CONTENT = 1000
+channel_contexts = OrderedDict()
+
+def _context_entry(msg):
+    return (msg.author == bot.user, msg.author.display_name, msg.clean_content[:CONTEXT_MAX_CONTENT])
+
+def _channel_context(channel_id):
+    context = channel_contexts.get(channel_id)
+    if context is None:
+        context = channel_contexts[channel_id] = {'seeded': False, 'messages': deque(maxlen=CONTEXT_HISTORY_SIZE)}
+        while len(channel_contexts) > CONTEXT_MAX_CHANNELS: channel_contexts.popitem(last=False)
+    else: channel_contexts.move_to_end(channel_id)
+    return context
+
+def record_context_message(message):
+    _channel_context(message.channel.id)['messages'].append(_context_entry(message))
+
+async def get_context_history(channel):
+    context = _channel_context(channel.id)
+    # Messages seen since startup count too: a buffer they have already filled needs no REST fetch.
+    if len(context['messages']) == CONTEXT_HISTORY_SIZE: context['seeded'] = True
+    inc('arts_cache_requests_total', cache='channel_context', result='hit' if context['seeded'] else 'miss')
+    if not context['seeded']:
+        history = [_context_entry(msg) async for msg in channel.history(limit=CONTEXT_HISTORY_SIZE)]
+        context['messages'] = deque(reversed(history), maxlen=CONTEXT_HISTORY_SIZE)
+        context['seeded'] = True
+    return list(context['messages'])
+
+async def chat_reply(message):
+    await asyncio.sleep(CHAT_COALESCE_WINDOW)
+    async with message.channel.typing():
+        context_history = await get_context_history(message.channel)
+        if message.author.id == MASTER_USER_ID and not message.content.startswith(bot.command_prefix):
+            try:
+                parsed_json = parse_owner_command(message.content, bot.user.id) or await parse_owner_command_llm(message)
+                if parsed_json.get("command") == "ping":
+                    user_id_to_ping = int(parsed_json.get("user_id")); amount = int(parsed_json.get("amount"))
+                    target_user = await bot.fetch_user(user_id_to_ping)
+                    if target_user:
+                        await queue_send(message.channel, f"Executing order: Pinging {target_user.mention} {amount} time{'s' if amount != 1 else ''}.")
+                        for i in range(min(amount, 10)):
+                            await queue_send(message.channel, f"Ping {i+1} for {target_user.mention}", merge=False)
+                        return
+            except Exception as e:
+                print(f"Master command parsing failed: {e}")
+
+        special_instructions = "The user you are replying to is your owner. Be extra witty and sarcastic." if message.author.id == MASTER_USER_ID else ""
+        system_prompt = (f"You are a witty and clever Discord bot named ARTS AUTOMATION. Your personality is sassy but helpful. "
+                         f"Keep responses very concise (1-2 witty sentences). Avoid long paragraphs. "
+                         f"**Crucially, do not start your reply with 'ARTS AUTOMATION:' or your own name. Just give the direct response.** {special_instructions}")
+        messages_for_api = [{"role": "system", "content": system_prompt}]
+        for is_bot_message, display_name, content in context_history:
+            role = "assistant" if is_bot_message else "user"
+            messages_for_api.append({"role": role, "content": f"{display_name}: {content}"})
+        try:
+            await message.reply(await groq_complete(message.guild.id, messages_for_api))
+        except Exception as e:
+            print(f"Error generating Groq response: {e}")
+
+# --- Member Index ---
+# Without a full member cache, each guild keeps a small LRU of recently active members (their
+# nickname and display name) and the set of moderators seen so far. Random picks, name lookups
+# and moderator pings read these instead of scanning guild.members.
+RECENT_MEMBERS_PER_GUILD = 256
+MAX_MODERATORS_PER_GUILD = 50
+MEMBER_SAMPLE_SIZE = 200
+recent_members = {}
+guild_moderators = {}
+
+def is_moderator(member):
+    return not member.bot and member.guild_permissions.manage_messages
+
+def note_member(member):
+    # Returns True when the member is new to the index or their nickname changed since last seen.
+    members = recent_members.setdefault(member.guild.id, OrderedDict())
+    previous = members.get(member.id)
+    members[member.id] = (member.nick, member.display_name)
+    members.move_to_end(member.id)
+    if len(members) > RECENT_MEMBERS_PER_GUILD: members.popitem(last=False)
+    moderators = guild_moderators.setdefault(member.guild.id, set())
+    if not is_moderator(member): moderators.discard(member.id)
+    elif len(moderators) < MAX_MODERATORS_PER_GUILD: moderators.add(member.id)
+    return previous is None or previous[0] != member.nick
+
+async def random_member_names(guild, k):
+    if not MEMBER_CACHE_BOUNDED: names = {m.id: m.display_name for m in guild.members if not m.bot}
+    else: names = {user_id: seen[1] for user_id, seen in recent_members.get(guild.id, {}).items()}
+    if len(names) < k and MEMBER_CACHE_BOUNDED:
+        # Too few members seen yet: fetch one page of members starting at a random snowflake,
+        # falling back to the first page if that lands past the newest account.
+        for after in (discord.Object(random.randrange(discord.utils.time_snowflake(discord.utils.utcnow()))), None):
+            try: names.update({m.id: m.display_name async for m in guild.fetch_members(limit=MEMBER_SAMPLE_SIZE, after=after) if not m.bot})
+            except discord.HTTPException: break
+            if len(names) >= k: break
+    return random.sample(list(names.values()), k) if len(names) >= k else []
+
+def moderator_mentions(guild):
+    if not MEMBER_CACHE_BOUNDED: return " ".join(m.mention for m in guild.members if is_moderator(m))
+    known = guild_moderators.get(guild.id)
+    if known: return " ".join(f"<@{user_id}>" for user_id in known)
+    # No moderator has been seen yet, so mention the roles that grant moderator permissions.
+    return " ".join(role.mention for role in guild.roles
+                    if not role.is_default() and not role.managed and (role.permissions.manage_messages or role.permissions.administrator))
 
 # --- Bot Events ---
+# Time from process start to login, to the bot being ready, and to the first message handled.
+startup_marks = set()
+startup_warmup = None
+bot_started = False
+
+def mark_startup(stage):
+    startup_marks.add(stage)
+    elapsed = time.monotonic() - PROCESS_STARTED
+    observe('arts_startup_seconds', elapsed, stage=stage)
+    print(f"Startup: {stage} after {elapsed:.2f}s")
+
+@bot.event
+async def setup_hook():
+    global http_session, loop_lag_task, startup_warmup
+    http_session = aiohttp.ClientSession()
+    instrument_http(bot.http)
+    await start_metrics_server()
+    loop_lag_task = bot.loop.create_task(monitor_loop_lag())
+    # The database, its migrations and the country catalog load while the gateway logs in.
+    startup_warmup = asyncio.gather(open_database(), load_country_catalog())
+    mark_startup('login')
+
 @bot.event
 async def on_ready():
-    init_db()
+    # on_ready fires again after every gateway re-identify; startup only has to happen once.
+    global giveaway_scheduler_task, infection_scheduler_task, bot_started
+    if bot_started: return print(f'Reconnected as {bot.user.name}')
+    bot_started = True
+    try: await startup_warmup
+    except Exception as e:
+        print(f"ERROR: Startup failed, shutting down: {e}")
+        return await bot.close()
+    await asyncio.gather(warm_guild_settings(), restore_game_state())
+    mark_startup('ready')
     print(f'Logged in as {bot.user.name}')
-    check_infections_task.start()
-    check_giveaways_task.start()
+    if not infection_scheduler_task: infection_scheduler_task = bot.loop.create_task(infection_scheduler())
+    if not giveaway_scheduler_task: giveaway_scheduler_task = bot.loop.create_task(giveaway_scheduler())
+    if not flush_user_writes_task.is_running(): flush_user_writes_task.start()
+    if not refresh_country_catalog_task.is_running(): refresh_country_catalog_task.start()
 
 @bot.event
+@timed_event
 async def on_message(message):
+    if 'first_message' not in startup_marks: mark_startup('first_message')
+    if message.guild: record_context_message(message)
     if not message.guild or message.author.bot: return
+    # member_update isn't delivered for uncached members, so nicknames are rechecked as members speak.
+    if MEMBER_CACHE_BOUNDED and note_member(message.author): await check_nickname(message.author)
 
     if not message.author.guild_permissions.manage_messages:
-        now = datetime.utcnow().timestamp()
         user_id = message.author.id
-        if user_id not in user_message_timestamps: user_message_timestamps[user_id] = []
-        user_message_timestamps[user_id].append(now)
-        user_message_timestamps[user_id] = [t for t in user_message_timestamps[user_id] if now - t < SPAM_TIMEFRAME]
-        if len(user_message_timestamps[user_id]) > SPAM_THRESHOLD:
-            user_message_timestamps[user_id] = []
-            user_data = get_user_data(message.guild.id, user_id)
+        if spam_limiter.hit(message.guild.id, user_id, time.monotonic()):
+            user_data = await get_user_data(message.guild.id, user_id)
             offenses = user_data[8] + 1
-            update_user_data(message.guild.id, user_id, 'spam_offenses', offenses)
+            await update_user_data(message.guild.id, user_id, 'spam_offenses', offenses)
             if offenses <= 3:
-                await message.channel.send(f"⚠️ {message.author.mention}, please stop spamming! (Warning {offenses}/3)")
+                await queue_send(message.channel, f"⚠️ {message.author.mention}, please stop spamming! (Warning {offenses}/3)")
             else:
                 mute_durations = {4: 5, 5: 15, 6: 30}
                 mute_duration = timedelta(minutes=mute_durations.get(offenses, 60))
                 try:
                     await message.author.timeout(mute_duration, reason=f"Spamming (Offense #{offenses})")
-                    await message.channel.send(f"🔇 {message.author.mention} has been timed out for spamming.")
+                    await queue_send(message.channel, f"🔇 {message.author.mention} has been timed out for spamming.")
                 except discord.Forbidden:
-                    await message.channel.send("Tried to timeout a spammer, but I'm missing `Moderate Members` permission.")
+                    await queue_send(message.channel, "Tried to timeout a spammer, but I'm missing `Moderate Members` permission.")
             return
 
+    # Commands always run as commands, even when their text would also trigger a chat reply.
+    if message.content.startswith(bot.command_prefix): return await bot.process_commands(message)
+
     is_reply_to_bot = message.reference and message.reference.resolved and message.reference.resolved.author == bot.user
-    trigger_words = ["bot", "arts", "arts automation"]
-    trigger_prefixes = ["!arts", "!ARTS"]
-    should_chat = (bot.user.mentioned_in(message) or is_reply_to_bot or any(word.lower() in message.content.lower() for word in trigger_words) or any(message.content.lower().startswith(prefix.lower()) for prefix in trigger_prefixes))
+    content_lower = message.content.lower()
+    should_chat = (bot.user.mentioned_in(message) or is_reply_to_bot or TRIGGER_PATTERN.search(content_lower) is not None or content_lower.startswith(TRIGGER_PREFIXES))
     game_is_active_here = message.guild.id in active_games and active_games[message.guild.id].get('channel_id') == message.channel.id
 
-    if groq_client and should_chat and not game_is_active_here:
-        async with message.channel.typing():
-            context_history = [msg async for msg in message.channel.history(limit=10)]
-            if message.author.id == MASTER_USER_ID and not message.content.startswith(bot.command_prefix):
-                system_prompt = ("You are a command parser. Analyze the user's request. The only command is 'ping'. "
-                                 "A ping request must have a user mention/ID and a number. "
-                                 "If it is a valid ping command, output ONLY a JSON object like: "
-                                 "`{\"command\": \"ping\", \"user_id\": \"<user_id>\", \"amount\": <number>}`. "
-                                 "Extract the numerical ID from the mention. For any other request, output ONLY: `{\"command\": \"chat\"}`.")
-                try:
-                    chat_completion = groq_client.chat.completions.create(messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": message.clean_content}], model="llama3-8b-8192")
-                    response_text = chat_completion.choices[0].message.content
-                    parsed_json = json.loads(response_text.strip('` \njson'))
-                    if parsed_json.get("command") == "ping":
-                        user_id_to_ping = int(parsed_json.get("user_id")); amount = int(parsed_json.get("amount"))
-                        target_user = await bot.fetch_user(user_id_to_ping)
-                        if target_user:
-                            await message.channel.send(f"Executing order: Pinging {target_user.mention} {amount} time{'s' if amount != 1 else ''}.")
-                            for i in range(min(amount, 10)):
-                                await message.channel.send(f"Ping {i+1} for {target_user.mention}")
-                                await asyncio.sleep(1)
-                            return
-                except Exception as e:
-                    print(f"Master command parsing failed: {e}")
-
-            special_instructions = "The user you are replying to is your owner. Be extra witty and sarcastic." if message.author.id == MASTER_USER_ID else ""
-            system_prompt = (f"You are a witty and clever Discord bot named ARTS AUTOMATION. Your personality is sassy but helpful. "
-                             f"Keep responses very concise (1-2 witty sentences). Avoid long paragraphs. "
-                             f"**Crucially, do not start your reply with 'ARTS AUTOMATION:' or your own name. Just give the direct response.** {special_instructions}")
-            messages_for_api = [{"role": "system", "content": system_prompt}]
-            for msg in reversed(context_history):
-                role = "assistant" if msg.author == bot.user else "user"
-                messages_for_api.append({"role": role, "content": f"{msg.author.display_name}: {msg.clean_content}"})
-            try:
-                chat_completion = groq_client.chat.completions.create(messages=messages_for_api, model="llama3-8b-8192")
-                await message.reply(chat_completion.choices[0].message.content)
-                return
-            except Exception as e:
-                print(f"Error generating Groq response: {e}")
-    
+    if should_chat and not groq_disabled and not game_is_active_here:
+        return schedule_chat_reply(message)
+
     guild_id = message.guild.id
     if guild_id in active_games and active_games[guild_id].get('channel_id') == message.channel.id:
-        if message.content.startswith(bot.command_prefix):
-            await bot.process_commands(message)
-            return
-        guess = message.content.lower().strip()
-        correct_answer = active_games[guild_id].get('answer', '').lower()
-        if correct_answer and guess == correct_answer:
-            game_data = active_games[guild_id]
+        game_data = active_games[guild_id]
+        correct_answer = game_data.get('answer')
+        if correct_answer and is_correct_guess(message.content, game_data['answers']):
             if game_data.get('timer_task'): game_data['timer_task'].cancel()
             active_games[guild_id]['answer'] = None
+            bot.loop.create_task(save_state(guild_id, 'game', {'channel_id': message.channel.id, 'answer': None, 'round_ends_at': time.time()}))
             user = message.author
-            await message.channel.send(f"**{user.display_name}** guessed it right! The country was **{correct_answer.title()}**.")
-            user_data = get_user_data(guild_id, user.id)
+            await queue_send(message.channel, f"**{user.display_name}** guessed it right! The country was **{correct_answer}**.")
+            user_data = await get_user_data(guild_id, user.id)
             old_level, xp, score = user_data[4], user_data[3], user_data[2]
             xp_gain = random.randint(15, 25); new_xp = xp + xp_gain
             new_level = int(new_xp**0.5 // 4)
-            update_user_data(guild_id, user.id, 'score', score + 1)
-            update_user_data(guild_id, user.id, 'xp', new_xp)
+            await update_user_data(guild_id, user.id, 'score', score + 1)
+            await update_user_data(guild_id, user.id, 'xp', new_xp)
             if new_level > old_level:
-                update_user_data(guild_id, user.id, 'level', new_level)
-                await message.channel.send(f"**LEVEL UP!** {user.display_name} has reached **Level {new_level}**!")
+                await update_user_data(guild_id, user.id, 'level', new_level)
+                await queue_send(message.channel, f"**LEVEL UP!** {user.display_name} has reached **Level {new_level}**!")
             if user_data[5] == 1:
-                update_user_data(guild_id, user.id, 'is_infected', 0)
+                await update_user_data(guild_id, user.id, 'is_infected', 0)
+                cancel_infection_cure(guild_id, user.id)
                 try: await user.edit(nick=user_data[6])
                 except: pass
-                await message.channel.send(f"✨ {user.display_name} has been cured!")
+                await queue_send(message.channel, f"✨ {user.display_name} has been cured!")
+            next_round_at = bot.loop.time() + ROUND_PAUSE_SECONDS
             await leaderboard(message.channel, guild_id)
-            await asyncio.sleep(3)
+            await asyncio.sleep(max(0, next_round_at - bot.loop.time()))
             await start_new_round(guild_id)
             return
         elif correct_answer:
-            user = message.author; user_data = get_user_data(guild_id, user.id)
+            user = message.author; user_data = await get_user_data(guild_id, user.id)
             if user_data[5] == 0:
                 try:
                     original_nick = message.author.nick
                     await message.author.edit(nick=f"{message.author.display_name} 🦠")
-                    update_user_data(guild_id, user.id, 'is_infected', 1)
-                    update_user_data(guild_id, user.id, 'original_nickname', original_nick)
-                    update_user_data(guild_id, user.id, 'infection_expiry', datetime.utcnow() + timedelta(minutes=30))
+                    expiry = datetime.utcnow() + INFECTION_DURATION
+                    await update_user_data(guild_id, user.id, 'is_infected', 1)
+                    await update_user_data(guild_id, user.id, 'original_nickname', original_nick)
+                    await update_user_data(guild_id, user.id, 'infection_expiry', expiry)
+                    schedule_infection_cure(guild_id, user.id, expiry, original_nick)
                     await message.add_reaction('🦠')
                 except discord.Forbidden:
-                    await message.channel.send(f"**Permissions Error!** I can't apply infection, I'm missing `Manage Nicknames` permission.")
+                    await queue_send(message.channel, f"**Permissions Error!** I can't apply infection, I'm missing `Manage Nicknames` permission.")
     
     await bot.process_commands(message)
 @bot.event
+@timed_event
+async def on_raw_reaction_add(payload):
+    if str(payload.emoji) != GIVEAWAY_EMOJI or str(payload.message_id) not in giveaway_deadlines: return
+    if payload.user_id == bot.user.id: return
+    await db_execute("INSERT INTO giveaway_entrants (message_id, user_id, is_bot) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING",
+                     str(payload.message_id), str(payload.user_id), bool(payload.member and payload.member.bot))
+@bot.event
+@timed_event
+async def on_raw_reaction_remove(payload):
+    if str(payload.emoji) != GIVEAWAY_EMOJI or str(payload.message_id) not in giveaway_deadlines: return
+    await db_execute("DELETE FROM giveaway_entrants WHERE message_id = $1 AND user_id = $2", str(payload.message_id), str(payload.user_id))
+@bot.event
+@timed_event
 async def on_member_join(member):
+    if MEMBER_CACHE_BOUNDED and not member.bot: note_member(member)
     await check_nickname(member)
 @bot.event
+@timed_event
 async def on_member_update(before, after):
     if before.nick != after.nick: await check_nickname(after)
 async def check_nickname(member):
     if member.guild_permissions.administrator or member.top_role >= member.guild.me.top_role: return
     nickname = member.nick or member.name
-    if any(b.lower() in nickname.lower() for b in BANNED_WORDS):
-        settings = get_guild_settings(member.guild.id); log_channel_id = settings[2]
+    if word_matcher_for(member.guild.id).search(nickname):
+        settings = await get_guild_settings(member.guild.id); log_channel_id = settings[2]
         if not log_channel_id: return
         log_channel = member.guild.get_channel(int(log_channel_id))
         if not log_channel: return
@@ -322,54 +1288,240 @@ async def check_nickname(member):
             embed.add_field(name="After", value="`Moderated Nickname`", inline=False)
             await log_channel.send(embed=embed)
         except: pass
-@tasks.loop(minutes=1)
-async def check_infections_task():
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT guild_id, user_id, original_nickname FROM users WHERE is_infected = 1 AND infection_expiry < %s", (datetime.utcnow(),))
-        for g_id, u_id, nick in cursor.fetchall():
-            try:
-                guild = bot.get_guild(int(g_id))
-                if not guild: continue
-                member = await guild.fetch_member(int(u_id))
-                await member.edit(nick=nick)
-                update_user_data(g_id, u_id, 'is_infected', 0)
-            except Exception as e: print(f"Error curing infection: {e}")
-@tasks.loop(seconds=5)
-async def check_giveaways_task():
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT message_id, channel_id, prize, winner_count FROM giveaways WHERE end_time < %s AND is_active = 1", (datetime.utcnow(),))
-        for g_id, c_id, prize, winners in cursor.fetchall():
-            cursor.execute("UPDATE giveaways SET is_active = 0 WHERE message_id = %s", (g_id,))
-            conn.commit()
-            channel = bot.get_channel(int(c_id))
-            if not channel: continue
-            try: message = await channel.fetch_message(int(g_id))
-            except: continue
-            entrants = [user async for reaction in message.reactions if str(reaction.emoji) == '🎉' for user in reaction.users() if not user.bot]
-            if not entrants:
-                await channel.send(f"Giveaway for **{prize}** ended! No one entered."); continue
-            winner_pool = random.sample(entrants, k=min(winners, len(entrants)))
-            winner_mentions = ", ".join(w.mention for w in winner_pool)
-            await channel.send(f"🎉 Congratulations {winner_mentions}! You won **{prize}**! 🎉")
-            embed = message.embeds[0]; embed.title = f"🎉 GIVEAWAY ENDED 🎉"; embed.description = f"**{prize}**\n\nWinners: {winner_mentions}"
-            embed.color = discord.Color.dark_grey(); await message.edit(embed=embed)
+# --- Infection Scheduler ---
+# Infection expiries sit in a min-heap; cures falling due within the same window are processed
+# together, nicknames restored concurrently under a cap, and the flags flushed as one batch.
+INFECTION_DURATION = timedelta(minutes=30)
+INFECTION_BATCH_WINDOW = timedelta(seconds=5)
+INFECTION_RETRY_DELAY = timedelta(minutes=5)
+NICKNAME_EDIT_CONCURRENCY = 5
+infection_heap = []
+infection_deadlines = {}
+infection_wakeup = asyncio.Event()
+infection_scheduler_task = None
+nickname_edit_semaphore = asyncio.Semaphore(NICKNAME_EDIT_CONCURRENCY)
+
+def schedule_infection_cure(guild_id, user_id, expiry, original_nick):
+    key = (str(guild_id), str(user_id))
+    infection_deadlines[key] = (expiry, original_nick)
+    heapq.heappush(infection_heap, (expiry, *key))
+    infection_wakeup.set()
+
+def cancel_infection_cure(guild_id, user_id):
+    infection_deadlines.pop((str(guild_id), str(user_id)), None)
+
+async def reconcile_infections():
+    await flush_user_writes()
+    rows = await db_fetch("SELECT guild_id, user_id, original_nickname, infection_expiry FROM users WHERE is_infected = 1 "
+                          "AND ($1::text[] IS NULL OR guild_id = ANY($1::text[]))", local_guild_ids())
+    infection_heap.clear(); infection_deadlines.clear()
+    for g_id, u_id, nick, expiry in rows: schedule_infection_cure(g_id, u_id, expiry or datetime.utcnow(), nick)
+
+async def _restore_nickname(g_id, u_id, nick):
+    guild = bot.get_guild(int(g_id))
+    if not guild: return False
+    async with nickname_edit_semaphore:
+        try:
+            member = guild.get_member(int(u_id)) or await guild.fetch_member(int(u_id))
+            await member.edit(nick=nick)
+        except discord.NotFound: pass
+        except Exception as e:
+            print(f"Error curing infection: {e}")
+            return False
+    return True
+
+async def cure_infections(due):
+    results = await asyncio.gather(*(_restore_nickname(*entry) for entry in due))
+    for (g_id, u_id, nick), cured in zip(due, results):
+        if cured: await update_user_data(g_id, u_id, 'is_infected', 0)
+        else: schedule_infection_cure(g_id, u_id, datetime.utcnow() + INFECTION_RETRY_DELAY, nick)
+    await flush_user_writes()
+
+async def infection_scheduler():
+    needs_reconcile = True
+    while True:
+        try:
+            if needs_reconcile: await reconcile_infections(); needs_reconcile = False
+            infection_wakeup.clear()
+            now, due = datetime.utcnow(), []
+            while infection_heap and infection_heap[0][0] <= now + INFECTION_BATCH_WINDOW:
+                expiry, g_id, u_id = heapq.heappop(infection_heap)
+                deadline = infection_deadlines.get((g_id, u_id))
+                if not deadline or deadline[0] != expiry: continue
+                del infection_deadlines[(g_id, u_id)]
+                due.append((g_id, u_id, deadline[1]))
+            if due:
+                await cure_infections(due)
+                continue
+            timeout = (infection_heap[0][0] - now).total_seconds() if infection_heap else None
+            try: await asyncio.wait_for(infection_wakeup.wait(), timeout)
+            except asyncio.TimeoutError: pass
+        except Exception as e:
+            print(f"Infection scheduler error, reconciling with the database: {e}")
+            needs_reconcile = True
+            await asyncio.sleep(INFECTION_RETRY_DELAY.total_seconds() / 10)
+
+# --- Giveaway Scheduler ---
+# Active giveaways sit in a min-heap by end time; the scheduler sleeps until the earliest one is
+# due or gstart/gend wake it. The database is only re-read at startup and after a failure.
+GIVEAWAY_RETRY_DELAY = 5
+giveaway_heap = []
+giveaway_deadlines = {}
+giveaway_wakeup = asyncio.Event()
+giveaway_scheduler_task = None
+
+def schedule_giveaway(message_id, end_time):
+    # Rescheduling leaves the old heap entry behind; it is skipped when its deadline no longer matches.
+    giveaway_deadlines[message_id] = end_time
+    heapq.heappush(giveaway_heap, (end_time, message_id))
+    giveaway_wakeup.set()
+
+async def reconcile_giveaways():
+    rows = await db_fetch("SELECT message_id, end_time FROM giveaways WHERE is_active = 1 AND ($1::text[] IS NULL OR guild_id = ANY($1::text[]))", local_guild_ids())
+    giveaway_heap.clear(); giveaway_deadlines.clear()
+    for message_id, end_time in rows: schedule_giveaway(message_id, end_time)
+
+# Entrants are recorded from raw reaction events as they arrive, so ending or rerolling draws
+# winners in Postgres instead of paging every reaction into memory.
+GIVEAWAY_EMOJI = '🎉'
+ENTRANT_BACKFILL_BATCH = 1000
+
+ENTRANT_INSERT_QUERY = "INSERT INTO giveaway_entrants (message_id, user_id, is_bot) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING"
+
+async def backfill_giveaway_entrants(message_id, reaction):
+    # Catches up on reactions added or removed while offline, or made before entrants were tracked.
+    batch, reacting = [], []
+    async for user in reaction.users(limit=None):
+        if user.id == bot.user.id: continue
+        batch.append((message_id, str(user.id), user.bot)); reacting.append(str(user.id))
+        if len(batch) >= ENTRANT_BACKFILL_BATCH: await db_executemany(ENTRANT_INSERT_QUERY, batch); batch = []
+    if batch: await db_executemany(ENTRANT_INSERT_QUERY, batch)
+    await db_execute("DELETE FROM giveaway_entrants WHERE message_id = $1 AND NOT user_id = ANY($2::text[])", message_id, reacting)
+
+async def draw_giveaway_winners(message, k):
+    message_id = str(message.id)
+    reaction = discord.utils.get(message.reactions, emoji=GIVEAWAY_EMOJI)
+    # The table holds every reactor but this bot, so a matching count means no reaction was missed.
+    expected = reaction.count - reaction.me if reaction else 0
+    if await db_fetchval("SELECT COUNT(*) FROM giveaway_entrants WHERE message_id = $1", message_id) != expected:
+        if reaction: await backfill_giveaway_entrants(message_id, reaction)
+        else: await db_execute("DELETE FROM giveaway_entrants WHERE message_id = $1", message_id)
+    return await pick_giveaway_entrants(message_id, k)
+
+async def pick_giveaway_entrants(message_id, k):
+    # Reactions stop being tracked once a giveaway ends, so rerolls draw from the entrants as they
+    # stood at the end without reconciling; late reactions don't enter.
+    rows = await db_fetch("SELECT user_id FROM giveaway_entrants WHERE message_id = $1 AND NOT is_bot ORDER BY random() LIMIT $2", str(message_id), k)
+    return [user_id for user_id, in rows]
+
+async def end_giveaway(g_id):
+    g_data = await db_fetchrow("UPDATE giveaways SET is_active = 0 WHERE message_id = $1 AND is_active = 1 RETURNING channel_id, prize, winner_count", g_id)
+    if not g_data: return
+    c_id, prize, winners = g_data
+    channel = bot.get_channel(int(c_id))
+    if not channel: return
+    try: message = await channel.fetch_message(int(g_id))
+    except: return
+    winner_pool = await draw_giveaway_winners(message, winners)
+    if not winner_pool:
+        return await channel.send(f"Giveaway for **{prize}** ended! No one entered.")
+    winner_mentions = ", ".join(f"<@{user_id}>" for user_id in winner_pool)
+    await channel.send(f"🎉 Congratulations {winner_mentions}! You won **{prize}**! 🎉")
+    embed = message.embeds[0]; embed.title = f"🎉 GIVEAWAY ENDED 🎉"; embed.description = f"**{prize}**\n\nWinners: {winner_mentions}"
+    embed.color = discord.Color.dark_grey(); await message.edit(embed=embed)
+
+async def giveaway_scheduler():
+    needs_reconcile = True
+    while True:
+        try:
+            if needs_reconcile: await reconcile_giveaways(); needs_reconcile = False
+            giveaway_wakeup.clear()
+            now = datetime.utcnow()
+            if giveaway_heap and giveaway_heap[0][0] <= now:
+                end_time, message_id = heapq.heappop(giveaway_heap)
+                if giveaway_deadlines.get(message_id) != end_time: continue
+                del giveaway_deadlines[message_id]
+                await end_giveaway(message_id)
+                continue
+            timeout = (giveaway_heap[0][0] - now).total_seconds() if giveaway_heap else None
+            try: await asyncio.wait_for(giveaway_wakeup.wait(), timeout)
+            except asyncio.TimeoutError: pass
+        except Exception as e:
+            print(f"Giveaway scheduler error, reconciling with the database: {e}")
+            needs_reconcile = True
+            await asyncio.sleep(GIVEAWAY_RETRY_DELAY)
+
+# --- Global Fan-Out ---
+# Owner commands that touch every guild run the per-guild call concurrently. Starts are paced
+# below Discord's global request limit; per-route buckets and 429 retries are left to
+# discord.py's HTTP client. Progress callbacks fire at a fixed rate, not once per guild.
+FANOUT_CONCURRENCY = 10
+FANOUT_MAX_PER_SECOND = 40
+FANOUT_PROGRESS_INTERVAL = 2.0
+EMBED_FIELD_LIMIT = 1024
+
+class FanOutSkip(Exception):
+    """Raised by a fan-out operation to count a guild as skipped rather than failed."""
+
+async def fan_out(guilds, operation, on_progress=None):
+    guilds = list(guilds)
+    report = {'succeeded': [], 'failed': [], 'skipped': []}
+    semaphore, pace_lock = asyncio.Semaphore(FANOUT_CONCURRENCY), asyncio.Lock()
+    next_start = bot.loop.time()
+
+    async def run(guild):
+        nonlocal next_start
+        async with semaphore:
+            async with pace_lock:
+                delay, next_start = next_start - bot.loop.time(), max(next_start, bot.loop.time()) + 1 / FANOUT_MAX_PER_SECOND
+                if delay > 0: await asyncio.sleep(delay)
+            try: await operation(guild)
+            except FanOutSkip: report['skipped'].append(guild)
+            except Exception as e: report['failed'].append((guild, type(e).__name__))
+            else: report['succeeded'].append(guild)
+
+    async def progress():
+        while True:
+            await asyncio.sleep(FANOUT_PROGRESS_INTERVAL)
+            try: await on_progress(sum(map(len, report.values())), len(guilds))
+            except discord.HTTPException: pass
+
+    progress_task = bot.loop.create_task(progress()) if on_progress else None
+    try: await asyncio.gather(*map(run, guilds))
+    finally:
+        if progress_task: progress_task.cancel()
+    return report
+
+def cluster_scope():
+    # Workers share no gateway state, so a global command only reaches the guilds on its own shards.
+    return f"Cluster worker {CLUSTER_WORKER_INDEX}: shards {', '.join(map(str, SHARD_IDS))} of {SHARD_COUNT} only." if SHARD_IDS is not None else None
+
+def format_guild_list(lines, limit=EMBED_FIELD_LIMIT):
+    text = ""
+    for i, line in enumerate(lines):
+        more = f"\n...and {len(lines) - i} more"
+        if len(text) + len(line) + 1 + len(more) > limit: return text + more
+        text += ("\n" if text else "") + line
+    return text or "None"
 
 # --- All Commands ---
 async def _start_game_logic(ctx):
     active_games[ctx.guild.id] = {'channel_id': ctx.channel.id}
-    settings = get_guild_settings(ctx.guild.id)
-    await ctx.send(f"🎉 **Flag Quiz Started!** (Difficulty: {settings[1]}) 🎉")
+    preload_next_round(ctx.guild.id)
+    settings = await get_guild_settings(ctx.guild.id)
+    await queue_send(ctx.channel, f"🎉 **Flag Quiz Started!** (Difficulty: {settings[1]}) 🎉")
     await start_new_round(ctx.guild.id)
 @bot.command(name='flagstart')
 async def flag_start(ctx):
-    if ctx.guild.id in active_games: return await ctx.send("A game is already running!")
+    if ctx.guild.id in active_games: return await queue_send(ctx.channel, "A game is already running!")
     if ctx.author.guild_permissions.manage_guild: await _start_game_logic(ctx)
     else:
         VOTE_THRESHOLD = 3; VOTE_DURATION = 60.0
         embed = discord.Embed(title="Vote to Start Flag Quiz!", description=f"{ctx.author.mention} wants to start a game. We need **{VOTE_THRESHOLD}** total votes!", color=discord.Color.gold())
         embed.set_footer(text=f"React with ✅. Vote ends in {int(VOTE_DURATION)} seconds.")
-        vote_msg = await ctx.send(embed=embed); await vote_msg.add_reaction("✅")
+        vote_msg = await queue_send(ctx.channel, embed=embed, merge=False, wait=True); await vote_msg.add_reaction("✅")
         voters = {ctx.author.id}
+        await save_state(ctx.guild.id, 'vote', {'channel_id': ctx.channel.id, 'message_id': vote_msg.id, 'ends_at': time.time() + VOTE_DURATION})
         def check(r, u): return str(r.emoji)=='✅' and u.id!=bot.user.id and r.message.id==vote_msg.id
         try:
             while len(voters) < VOTE_THRESHOLD:
@@ -380,53 +1532,56 @@ async def flag_start(ctx):
                     voters.add(user.id)
                     embed.description = f"{ctx.author.mention} wants to start a game!\n\n**Votes: {len(voters)}/{VOTE_THRESHOLD}**"
                     await vote_msg.edit(embed=embed)
+            await save_state(ctx.guild.id, 'vote')
             embed.title = "Vote Passed!"; embed.description = "Starting game..."
             await vote_msg.edit(embed=embed); await vote_msg.clear_reactions()
             await _start_game_logic(ctx)
         except asyncio.TimeoutError:
+            await save_state(ctx.guild.id, 'vote')
             embed.title = "Vote Failed"; embed.description = "Not enough votes."
             await vote_msg.edit(embed=embed); await vote_msg.clear_reactions()
 @bot.command(name='flagstop')
 @commands.has_permissions(manage_guild=True)
 async def flag_stop(ctx):
-    if ctx.guild.id not in active_games: return await ctx.send("No game running.")
-    game_data = active_games.pop(ctx.guild.id, None)
+    if ctx.guild.id not in active_games: return await queue_send(ctx.channel, "No game running.")
+    game_data = end_game(ctx.guild.id)
     if game_data and game_data.get('timer_task'): game_data['timer_task'].cancel()
-    await ctx.send("🏁 **Flag Quiz Ended!** 🏁"); await leaderboard(ctx.channel, ctx.guild.id)
+    await queue_send(ctx.channel, "🏁 **Flag Quiz Ended!** 🏁"); await leaderboard(ctx.channel, ctx.guild.id)
 @bot.command(name='flagskip')
 @commands.has_permissions(manage_guild=True)
 async def flag_skip(ctx):
-    if ctx.guild.id not in active_games: return await ctx.send("No game to skip.")
+    if ctx.guild.id not in active_games: return await queue_send(ctx.channel, "No game to skip.")
     game_data = active_games[ctx.guild.id]
     if game_data.get('timer_task'): game_data['timer_task'].cancel()
-    correct_answer = game_data.get('answer', 'an unknown flag')
-    await ctx.send(f"Flag skipped. The answer was **{correct_answer}**. Loading next flag...")
+    correct_answer = game_data.get('answer') or 'an unknown flag'
+    await queue_send(ctx.channel, f"Flag skipped. The answer was **{correct_answer}**. Loading next flag...")
     await start_new_round(ctx.guild.id)
 @bot.command(name='difficulty')
 @commands.has_permissions(manage_guild=True)
 async def difficulty(ctx, level: str.lower):
     if level not in ['easy', 'normal', 'hard']: return await ctx.send("Invalid. Choose `easy`, `normal`, or `hard`.")
-    update_guild_settings(ctx.guild.id, 'difficulty', level)
+    await update_guild_settings(ctx.guild.id, 'difficulty', level)
     await ctx.send(f"Game difficulty set to **{level}**.")
 @bot.command(name='leaderboard', aliases=['lb'])
 async def leaderboard_command(ctx):
     await leaderboard(ctx.channel, ctx.guild.id)
 @bot.command(name='gleaderboard', aliases=['glb'])
-async def global_leaderboard(ctx):
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT user_id, SUM(score) as total FROM users WHERE score > 0 GROUP BY user_id ORDER BY total DESC LIMIT 10")
-        global_top = cursor.fetchall()
-    if not global_top: return await ctx.send("Global leaderboard is empty!")
+async def global_leaderboard(ctx, page: int = 1):
+    page = max(page, 1)
+    await flush_user_writes()
+    global_top = await get_global_top(page)
+    if not global_top: return await ctx.send("Global leaderboard is empty!" if page == 1 else f"No entries on page {page}.")
     embed = discord.Embed(title="🏆 Global Leaderboard 🏆", color=discord.Color.purple())
-    for i, (user_id, total_score) in enumerate(global_top):
-        try: user_name = (await bot.fetch_user(int(user_id))).display_name
-        except: user_name = f"Unknown User"
+    if page > 1: embed.set_footer(text=f"Page {page}")
+    names = await resolve_display_names([int(user_id) for user_id, _ in global_top])
+    for i, (user_id, total_score) in enumerate(global_top, start=(page - 1) * 10):
+        user_name = names[int(user_id)]
         emoji = ["🥇", "🥈", "🥉"][i] if i < 3 else "🔹"
         embed.add_field(name=f"{emoji} {i+1}. {user_name}", value=f"**{total_score}** total points", inline=False)
     await ctx.send(embed=embed)
 @bot.command(name="profile", aliases=["stats", "level"])
 async def profile(ctx, member: discord.Member = None):
-    member = member or ctx.author; user_data = get_user_data(ctx.guild.id, member.id)
+    member = member or ctx.author; user_data = await get_user_data(ctx.guild.id, member.id)
     embed = discord.Embed(title=f"{member.display_name}'s Profile", color=member.color)
     embed.set_thumbnail(url=member.display_avatar.url)
     embed.add_field(name="Level", value=f"**{user_data[4]}**"); embed.add_field(name="XP", value=f"**{user_data[3]}**")
@@ -441,19 +1596,19 @@ async def height(ctx, member: discord.Member = None):
     await ctx.send(f"📏 **{member.display_name}** is **{h_val} {unit}** tall.")
 @bot.command(name="serverlore")
 async def server_lore(ctx):
-    user_data = get_user_data(ctx.guild.id, ctx.author.id)
+    user_data = await get_user_data(ctx.guild.id, ctx.author.id)
     if user_data[4] < 3: return await ctx.send("You must reach **Level 3** to access server lore!")
-    members = [m for m in ctx.guild.members if not m.bot]
-    if len(members) < 2: return await ctx.send("Not enough humans for a good story!")
-    u1, u2 = random.sample(members, 2)
+    names = await random_member_names(ctx.guild, 2)
+    if len(names) < 2: return await ctx.send("Not enough humans for a good story!")
+    u1, u2 = names
     events = ["The Great Emoji War", "The Day of a Thousand Pings"]; outcomes = ["led to #memes", "and things were never the same"]
-    lore = f"In ancient server history, **{random.choice(events)}** between **{u1.display_name}** and **{u2.display_name}** concluded, {random.choice(outcomes)}."
+    lore = f"In ancient server history, **{random.choice(events)}** between **{u1}** and **{u2}** concluded, {random.choice(outcomes)}."
     await ctx.send(f"📜 A page from the archives reveals...\n\n{lore}")
 @bot.command(name='flaglog')
 @commands.has_permissions(manage_guild=True)
 async def flaglog(ctx, channel: discord.TextChannel = None):
-    if channel: update_guild_settings(ctx.guild.id, 'log_channel', str(channel.id)); await ctx.send(f"✅ Log Channel set to {channel.mention}.")
-    else: update_guild_settings(ctx.guild.id, 'log_channel', None); await ctx.send("🗑️ Log Channel cleared.")
+    if channel: await update_guild_settings(ctx.guild.id, 'log_channel', str(channel.id)); await ctx.send(f"✅ Log Channel set to {channel.mention}.")
+    else: await update_guild_settings(ctx.guild.id, 'log_channel', None); await ctx.send("🗑️ Log Channel cleared.")
 def parse_duration(d_str: str):
     parts = re.findall(r'(\d+)(s|m|h|d)', d_str.lower())
     if not parts: return None
@@ -467,53 +1622,76 @@ async def gstart(ctx, duration: str, winners: int, *, prize: str):
     end = datetime.utcnow() + d_td
     embed = discord.Embed(title="🎉 GIVEAWAY 🎉", color=discord.Color.magenta())
     embed.description = f"**{prize}**\n\nReact with 🎉 to enter!\nEnds: <t:{int(end.timestamp())}:R> ({winners} winner{'s' if winners > 1 else ''})"
-    g_msg = await ctx.send(embed=embed); await g_msg.add_reaction("🎉")
-    with conn.cursor() as cursor:
-        cursor.execute("INSERT INTO giveaways (message_id, channel_id, guild_id, end_time, prize, winner_count) VALUES (%s, %s, %s, %s, %s, %s)",
-                       (str(g_msg.id), str(ctx.channel.id), str(ctx.guild.id), end, prize, winners))
-    conn.commit()
+    g_msg = await ctx.send(embed=embed); await g_msg.add_reaction(GIVEAWAY_EMOJI)
+    await db_execute("INSERT INTO giveaways (message_id, channel_id, guild_id, end_time, prize, winner_count) VALUES ($1, $2, $3, $4, $5, $6)",
+                     str(g_msg.id), str(ctx.channel.id), str(ctx.guild.id), end, prize, winners)
+    schedule_giveaway(str(g_msg.id), end)
     try: await ctx.message.delete()
     except: pass
 @bot.command(name='greroll')
 @commands.has_permissions(manage_guild=True)
 async def greroll(ctx, message_id: str):
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT prize, channel_id FROM giveaways WHERE message_id = %s AND is_active = 0", (message_id,))
-        g_data = cursor.fetchone()
+    g_data = await db_fetchrow("SELECT prize, channel_id FROM giveaways WHERE message_id = $1 AND is_active = 0", message_id)
     if not g_data: return await ctx.send("Not a valid, ended giveaway ID.")
-    try:
-        channel = bot.get_channel(int(g_data[1])); msg = await channel.fetch_message(int(message_id))
-    except: return await ctx.send("Could not find original message.")
-    entrants = [u async for r in msg.reactions if str(r.emoji)=='🎉' for u in r.users() if not u.bot]
-    if not entrants: return await ctx.send("No entrants to reroll from.")
-    winner = random.choice(entrants)
-    await ctx.send(f"🎉 The new winner is {winner.mention}! Congratulations on winning **{g_data[0]}**!")
+    winner = await pick_giveaway_entrants(message_id, 1)
+    if not winner:
+        # Giveaways that ended before entrants were recorded have to be read from their reactions.
+        try:
+            channel = bot.get_channel(int(g_data[1])); msg = await channel.fetch_message(int(message_id))
+        except: return await ctx.send("Could not find original message.")
+        winner = await draw_giveaway_winners(msg, 1)
+    if not winner: return await ctx.send("No entrants to reroll from.")
+    await ctx.send(f"🎉 The new winner is <@{winner[0]}>! Congratulations on winning **{g_data[0]}**!")
 @bot.command(name='gend')
 @commands.has_permissions(manage_guild=True)
 async def gend(ctx, message_id: str):
-    with conn.cursor() as cursor:
-        cursor.execute("UPDATE giveaways SET end_time = %s WHERE message_id = %s AND is_active = 1", (datetime.utcnow(), message_id))
-        if cursor.rowcount == 0: return await ctx.send("Not a valid, active giveaway ID.")
-    conn.commit()
-    await ctx.send("✅ Giveaway will end within 5 seconds.")
+    now = datetime.utcnow()
+    status = await db_execute("UPDATE giveaways SET end_time = $1 WHERE message_id = $2 AND is_active = 1", now, message_id)
+    if status.endswith(" 0"): return await ctx.send("Not a valid, active giveaway ID.")
+    schedule_giveaway(message_id, now)
+    await ctx.send("✅ Ending the giveaway now.")
 @bot.command(name='resetoffenses')
 @commands.has_permissions(manage_guild=True)
 async def resetoffenses(ctx, member: discord.Member):
-    update_user_data(ctx.guild.id, member.id, 'spam_offenses', 0)
+    await update_user_data(ctx.guild.id, member.id, 'spam_offenses', 0)
     await ctx.send(f"✅ Reset spam offenses for {member.mention}.")
+@bot.command(name='banword')
+@commands.has_permissions(manage_guild=True)
+async def banword(ctx, *, word: str):
+    word = word.lower().strip()
+    if not await add_guild_banned_word(ctx.guild.id, word, MAX_GUILD_BANNED_WORDS):
+        settings = _cache_guild_settings(await db_fetchrow(GUILD_ROW_QUERY, str(ctx.guild.id)))
+        if word in (settings[5] or []): return await ctx.send("That word is already banned here.")
+        return await ctx.send(f"This server already has the maximum of {MAX_GUILD_BANNED_WORDS} banned words.")
+    guild_word_matcher(ctx.guild.id).add(word)
+    await ctx.send(f"✅ Added `{word}` to this server's banned nickname words.")
+@bot.command(name='unbanword')
+@commands.has_permissions(manage_guild=True)
+async def unbanword(ctx, *, word: str):
+    word = word.lower().strip()
+    if not await remove_guild_banned_word(ctx.guild.id, word): return await ctx.send("That word isn't on this server's list.")
+    if word not in default_word_matcher.words: guild_word_matcher(ctx.guild.id).remove(word)
+    await ctx.send(f"🗑️ Removed `{word}` from this server's banned nickname words.")
+@bot.command(name='spamlimit')
+@commands.has_permissions(manage_guild=True)
+async def spamlimit(ctx, threshold: int, seconds: float):
+    if not 1 <= threshold <= 50 or not 0.5 <= seconds <= 60: return await ctx.send("Threshold must be 1-50 messages and the window 0.5-60 seconds.")
+    await update_guild_settings(ctx.guild.id, 'spam_threshold', threshold)
+    await update_guild_settings(ctx.guild.id, 'spam_timeframe', seconds)
+    spam_limiter.set_guild_limits(ctx.guild.id, threshold, seconds)
+    await ctx.send(f"✅ Spam limit set to **{threshold}** messages per **{seconds:g}s**.")
 @bot.command(name='fping') # RENAMED
 async def fping(ctx, member: discord.Member, amount: int = 1):
     if amount > 10: return await ctx.send("I can't ping more than 10 times, that's just mean.")
     for i in range(amount):
-        await ctx.send(f"Ping {i+1} for {member.mention}")
-        await asyncio.sleep(1)
+        await queue_send(ctx.channel, f"Ping {i+1} for {member.mention}", merge=False)
 @bot.command(name='flaghelp')
 async def flag_help(ctx):
     embed = discord.Embed(title="🚩 Flag Quiz Help 🚩", color=discord.Color.blurple())
     embed.add_field(name="Game", value="`?flagstart` `?flagstop` `?flagskip`", inline=False)
-    embed.add_field(name="Leaderboards", value="`?lb` (Server) `?glb` (Global)", inline=False)
+    embed.add_field(name="Leaderboards", value="`?lb` (Server) `?glb [page]` (Global)", inline=False)
     embed.add_field(name="Fun", value="`?profile` `?height` `?serverlore` `?fping`", inline=False)
-    embed.add_field(name="Moderation", value="`?resetoffenses` `?flaglog` `?difficulty`", inline=False)
+    embed.add_field(name="Moderation", value="`?resetoffenses` `?spamlimit` `?banword` `?unbanword` `?flaglog` `?difficulty`", inline=False)
     embed.add_field(name="Giveaways", value="`?gstart` `?greroll` `?gend`", inline=False)
     await ctx.send(embed=embed)
 @bot.command(name='gban')
@@ -522,51 +1700,74 @@ async def gban(ctx, member: discord.Member, *, reason: str = "No reason provided
     if member.id == ctx.author.id or member.id == bot.user.id: return await ctx.send("Cannot target self.")
     embed = discord.Embed(title="GLOBAL BANISHMENT PROTOCOL", color=discord.Color.dark_red()); embed.set_author(name="SYSTEM ALERT: THREAT DETECTED"); embed.add_field(name="Status", value="`Initializing...`", inline=False); msg = await ctx.send(embed=embed)
     await asyncio.sleep(2); embed.clear_fields(); embed.add_field(name="Status", value="`Acquiring target...`"); embed.add_field(name="Target Locked", value=f"{member.mention}"); embed.add_field(name="Reason", value=f"`{reason}`"); await msg.edit(embed=embed)
-    await asyncio.sleep(2.5); success_guilds, failed_guilds, total_guilds = [], [], len(bot.guilds)
-    for i, guild in enumerate(bot.guilds):
-        embed.clear_fields(); embed.add_field(name="Status", value=f"`Propagating ban... Guild {i+1}/{total_guilds}`"); embed.add_field(name="Current Node", value=f"**{guild.name}**"); await msg.edit(embed=embed); await asyncio.sleep(0.5)
-        try: await guild.ban(member, reason=f"Global Ban by {ctx.author} | Reason: {reason}"); success_guilds.append(f"**{guild.name}**")
-        except Exception as e: failed_guilds.append(f"**{guild.name}**: Failed - {type(e).__name__}")
+    await asyncio.sleep(2.5)
+    async def show_progress(done, total):
+        embed.clear_fields(); embed.add_field(name="Status", value=f"`Propagating ban... Guild {done}/{total}`"); await msg.edit(embed=embed)
+    async def ban(guild): await guild.ban(member, reason=f"Global Ban by {ctx.author} | Reason: {reason}")
+    await show_progress(0, len(bot.guilds))
+    report = await fan_out(bot.guilds, ban, show_progress)
+    success_guilds = [f"**{guild.name}**" for guild in report['succeeded']]
+    failed_guilds = [f"**{guild.name}**: Failed - {error}" for guild, error in report['failed']]
     embed.title="GLOBAL BANISHMENT COMPLETE"; embed.set_author(name="SYSTEM REPORT"); embed.clear_fields(); embed.add_field(name="Target", value=f"{member.mention}"); embed.color=discord.Color.green() if not failed_guilds else discord.Color.orange()
-    if success_guilds: embed.add_field(name="✅ Banned In", value="\n".join(success_guilds) or "None", inline=False)
-    if failed_guilds: embed.add_field(name="❌ Failed In", value="\n".join(failed_guilds) or "None", inline=False)
+    if success_guilds: embed.add_field(name="✅ Banned In", value=format_guild_list(success_guilds), inline=False)
+    if failed_guilds: embed.add_field(name="❌ Failed In", value=format_guild_list(failed_guilds), inline=False)
+    if cluster_scope(): embed.set_footer(text=cluster_scope())
     await msg.edit(embed=embed)
 @bot.command(name='gunban')
 @commands.is_owner()
 async def gunban(ctx, user_id: int, *, reason: str = "No reason provided."):
     try: user_to_unban = await bot.fetch_user(user_id)
     except: return await ctx.send("Could not find a user with that ID.")
-    success_guilds, failed_guilds = [], []
     await ctx.send(f"Initiating global unban for **{user_to_unban.name}**...")
-    for guild in bot.guilds:
-        try: await guild.unban(user_to_unban, reason=f"Global Unban by {ctx.author}: {reason}"); success_guilds.append(guild.name)
-        except: failed_guilds.append(guild.name)
+    async def unban(guild): await guild.unban(user_to_unban, reason=f"Global Unban by {ctx.author}: {reason}")
+    report = await fan_out(bot.guilds, unban)
+    success_guilds = [guild.name for guild in report['succeeded']]
+    failed_guilds = [guild.name for guild, _ in report['failed']]
     embed = discord.Embed(title="Global Unban Report", color=discord.Color.green()); embed.add_field(name="Target", value=f"{user_to_unban.name}")
-    if success_guilds: embed.add_field(name="✅ Unbanned In", value="\n".join(success_guilds) or "None")
-    if failed_guilds: embed.add_field(name="❌ Failed In", value="\n".join(failed_guilds) or "None")
+    if success_guilds: embed.add_field(name="✅ Unbanned In", value=format_guild_list(success_guilds))
+    if failed_guilds: embed.add_field(name="❌ Failed In", value=format_guild_list(failed_guilds))
+    if cluster_scope(): embed.set_footer(text=cluster_scope())
     await ctx.send(embed=embed)
 @bot.command(name='gannounce')
 @commands.is_owner()
 async def global_announce(ctx, *, message: str):
-    success_count, fail_count, unconfigured_guilds = 0, 0, []
     embed = discord.Embed(title="Global Announcement", description=message, color=discord.Color.red(), timestamp=datetime.utcnow())
     embed.set_author(name=f"From Bot Developer: {ctx.author.name}", icon_url=ctx.author.display_avatar.url)
     await ctx.send(f"📡 Starting global announcement to {len(bot.guilds)} servers...")
-    for guild in bot.guilds:
-        settings = get_guild_settings(guild.id); log_channel_id = settings[2]
-        if not log_channel_id: unconfigured_guilds.append(guild.name); continue
+    async def announce(guild):
+        settings = await get_guild_settings(guild.id); log_channel_id = settings[2]
+        if not log_channel_id: raise FanOutSkip
         target_channel = guild.get_channel(int(log_channel_id))
-        if not target_channel or not target_channel.permissions_for(guild.me).send_messages: fail_count += 1; continue
-        mods_to_ping = " ".join([m.mention for m in guild.members if not m.bot and m.guild_permissions.manage_messages])
-        try: await target_channel.send(content=mods_to_ping or "Attention Moderators,", embed=embed); success_count += 1
-        except Exception as e: print(f"Failed in '{guild.name}': {e}"); fail_count += 1
-        await asyncio.sleep(1)
-    report = f"**Global Announcement Complete!**\n✅ Success: **{success_count}**\n❌ Failures: **{fail_count}**"
-    await ctx.send(report)
+        if not target_channel or not target_channel.permissions_for(guild.me).send_messages: raise LookupError("log channel unavailable")
+        mods_to_ping = moderator_mentions(guild)
+        try: await target_channel.send(content=mods_to_ping or "Attention Moderators,", embed=embed)
+        except Exception as e: print(f"Failed in '{guild.name}': {e}"); raise
+    report = await fan_out(bot.guilds, announce)
+    unconfigured_guilds = [f"- {guild.name}" for guild in report['skipped']]
+    await ctx.send(f"**Global Announcement Complete!**\n✅ Success: **{len(report['succeeded'])}**\n❌ Failures: **{len(report['failed'])}**" + (f"\n-# {cluster_scope()}" if cluster_scope() else ""))
     if unconfigured_guilds:
-        dm_message = "The following servers have no log channel set:\n- " + "\n- ".join(unconfigured_guilds)
+        dm_message = "The following servers have no log channel set:\n" + format_guild_list(unconfigured_guilds, limit=1900)
         try: await ctx.author.send(dm_message)
         except: await ctx.send("Could not DM you the list of unconfigured servers.")
+@bot.command(name='botstats')
+@commands.is_owner()
+async def botstats(ctx):
+    def summarize(name, label):
+        rows = sorted(((dict(labels).get(label, name), hist) for (n, labels), hist in metric_histograms.items() if n == name), key=lambda r: -r[1][-1])
+        return "\n".join(f"`{key}`: {hist[-1]} | avg {hist[-2] / hist[-1] * 1000:.1f}ms | p99 ≤{histogram_quantile(hist, 0.99) * 1000:g}ms" for key, hist in rows[:8]) or "No data"
+    caches = {}
+    for (n, labels), value in metric_counters.items():
+        if n == 'arts_cache_requests_total': labels = dict(labels); caches.setdefault(labels['cache'], {})[labels['result']] = value
+    embed = discord.Embed(title="📊 Bot Stats", color=discord.Color.teal())
+    for title, name, label in [("Events", 'arts_event_seconds', 'event'), ("Commands", 'arts_command_seconds', 'command'),
+                               ("DB Queries", 'arts_db_query_seconds', 'query'), ("Discord REST", 'arts_discord_rest_seconds', 'route'),
+                               ("Groq", 'arts_groq_request_seconds', None), ("Event Loop Lag", 'arts_event_loop_lag_seconds', None),
+                               ("Startup", 'arts_startup_seconds', 'stage')]:
+        embed.add_field(name=title, value=summarize(name, label)[:EMBED_FIELD_LIMIT], inline=False)
+    groq_errors = sum(v for (n, _), v in metric_counters.items() if n == 'arts_groq_errors_total')
+    embed.add_field(name="Groq Errors", value=str(groq_errors))
+    embed.add_field(name="Cache Hit Rates", value="\n".join(f"`{c}`: {r.get('hit', 0) / max(sum(r.values()), 1):.0%} of {sum(r.values())}" for c, r in caches.items()) or "No data")
+    await ctx.send(embed=embed)
 @bot.command(name='forceupdate', aliases=['fupdate'])
 @commands.is_owner()
 async def force_update(ctx):
@@ -595,5 +1796,60 @@ async def on_command_error(ctx, error):
         await ctx.send("An unexpected error occurred.")
 
 # --- Run the Bot ---
+async def main():
+    # Cluster workers are stopped with SIGTERM; close the bot so the buffers below still flush.
+    try: asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: bot.loop.create_task(bot.close()))
+    except NotImplementedError: pass
+    async with bot:
+        try: await bot.start(BOT_TOKEN)
+        finally:
+            await flush_user_writes()
+            await close_db_pool()
+            if http_session: await http_session.close()
+            if metrics_runner: await metrics_runner.cleanup()
+
+# Each worker is a fresh `python main.py` with its shard slice in the environment, so nothing
+# but the database is shared. Crashed workers are restarted with a capped backoff.
+CLUSTER_RESTART_DELAY = 5
+CLUSTER_MAX_RESTART_DELAY = 300
+
+def run_cluster():
+    def spawn(index):
+        shard_ids = range(index, SHARD_COUNT, CLUSTER_WORKERS)
+        env = dict(os.environ, CLUSTER_WORKER_INDEX=str(index), SHARD_COUNT=str(SHARD_COUNT), SHARD_IDS=",".join(map(str, shard_ids)))
+        if METRICS_PORT: env['METRICS_PORT'] = str(METRICS_PORT + index)
+        print(f"Starting cluster worker {index} with shards {list(shard_ids)} of {SHARD_COUNT}.")
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+    if SHARD_COUNT < CLUSTER_WORKERS: return print(f"ERROR: SHARD_COUNT ({SHARD_COUNT}) must be at least CLUSTER_WORKERS ({CLUSTER_WORKERS}).")
+    def stop(signum, frame): raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, stop)
+    workers = {index: spawn(index) for index in range(CLUSTER_WORKERS)}
+    started = {index: time.monotonic() for index in workers}
+    restart_at, delays = {}, {index: CLUSTER_RESTART_DELAY for index in workers}
+    try:
+        while True:
+            time.sleep(1)
+            for index, proc in workers.items():
+                if proc.poll() is None or index in restart_at: continue
+                # A worker that stayed up for a while gets a fresh backoff; a crash loop keeps doubling it.
+                if time.monotonic() - started[index] > CLUSTER_MAX_RESTART_DELAY: delays[index] = CLUSTER_RESTART_DELAY
+                print(f"Cluster worker {index} exited with code {proc.returncode}, restarting in {delays[index]}s.")
+                restart_at[index] = time.monotonic() + delays[index]
+                delays[index] = min(delays[index] * 2, CLUSTER_MAX_RESTART_DELAY)
+            for index, when in list(restart_at.items()):
+                if time.monotonic() >= when:
+                    workers[index], started[index] = spawn(index), time.monotonic()
+                    del restart_at[index]
+    except KeyboardInterrupt: pass
+    finally:
+        for proc in workers.values(): proc.terminate()
+        for proc in workers.values():
+            try: proc.wait(timeout=30)
+            except subprocess.TimeoutExpired: proc.kill()
+
 if __name__ == "__main__":
-    bot.run(BOT_TOKEN)
+    discord.utils.setup_logging()
+    if CLUSTER_WORKERS > 1 and SHARD_IDS is None: run_cluster()
+    else:
+        try: asyncio.run(main())
+        except KeyboardInterrupt: pass